@@ -0,0 +1,367 @@
+'''Benchmarks for the DynamicClassifyObjects module
+
+Runs ClassifyObjects.run against a lightweight stand-in for the CellProfiler
+workspace (measurements, object set and image set) and reports the wall
+time, peak memory, memory and number of blocks left allocated for each
+combination of object count, bin count, number of classifications, image
+size, whether classified images are retained and the number of rendering
+threads.
+
+It also times loading a pipeline's settings for the module, validating them,
+listing its settings and visible settings and listing its measurements, for
+modules with different numbers of classifications (--load-groups, which can
+be given without numbers to skip these timings).
+
+Results are written as JSON so that runs can be compared over time:
+
+    python benchmarks/benchmark_dynamicclassifyobjects.py --objects 1000
+        100000 --bins 2 50 --output results.json
+
+CellProfiler and numpy must be importable. The module is imported from the
+directory above this one.
+'''
+
+# This module is distributed under the GNU General Public License.
+# See the accompanying file LICENSE for details.
+#
+# Copyright (c) 2014 Edward J. Stronge
+
+from __future__ import print_function
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import cellprofiler.preferences as cpprefs
+import cellprofiler.measurements as cpmeas
+import dynamicclassifyobjects as dco
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 - fall back to the process's peak resident size
+    tracemalloc = None
+    import resource
+
+OBJECT_NAME = "Nuclei"
+FEATURE_FORMAT = "Benchmark_Feature%d"
+LOW_THRESHOLD_FEATURE = "Benchmark_LowThreshold"
+
+
+class FakeMeasurements(object):
+    '''Just enough of cellprofiler.measurements.Measurements for run() and
+    post_run()'''
+
+    def __init__(self):
+        self.image_set_number = 1
+        self.measurements = {}
+        self.write_count = 0
+
+    def get_current_measurement(self, object_name, feature_name):
+        return self.measurements[object_name, feature_name,
+                                 self.image_set_number]
+
+    def get_current_image_measurement(self, feature_name):
+        return self.get_current_measurement(cpmeas.IMAGE, feature_name)
+
+    def get_measurement(self, object_name, feature_name,
+                        image_set_number=None):
+        if image_set_number is None:
+            image_set_number = self.image_set_number
+        if np.isscalar(image_set_number):
+            return self.measurements.get(
+                (object_name, feature_name, image_set_number))
+        return [self.measurements.get((object_name, feature_name, number))
+                for number in image_set_number]
+
+    def get_image_numbers(self):
+        return sorted(set([number for object_name, _, number
+                           in self.measurements
+                           if object_name == cpmeas.IMAGE]))
+
+    def add_measurement(self, object_name, feature_name, data,
+                        can_overwrite=False, image_set_number=None,
+                        data_type=None):
+        if image_set_number is None:
+            image_set_number = self.image_set_number
+        self.measurements[object_name, feature_name, image_set_number] = data
+        self.write_count += 1
+
+    def add_experiment_measurement(self, feature_name, data):
+        self.add_measurement(cpmeas.EXPERIMENT, feature_name, data)
+
+
+class FakeObjects(object):
+    '''Objects with a label matrix and a lazily computed ijv'''
+
+    def __init__(self, segmented):
+        self.segmented = segmented
+        self.shape = segmented.shape
+        self.parent_image = None
+        self.__ijv = None
+
+    @property
+    def ijv(self):
+        if self.__ijv is None:
+            i, j = np.nonzero(self.segmented)
+            self.__ijv = np.column_stack((i, j, self.segmented[i, j]))
+        return self.__ijv
+
+
+class FakeObjectSet(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_objects(self, objects_name):
+        return self.objects[objects_name]
+
+
+class FakeImageSet(object):
+    def __init__(self):
+        self.images = {}
+
+    def add(self, name, image):
+        self.images[name] = image
+
+
+class FakeDisplayData(object):
+    pass
+
+
+class FakeWorkspace(object):
+    def __init__(self, measurements, object_set, image_set):
+        self.measurements = measurements
+        self.object_set = object_set
+        self.image_set = image_set
+        self.display_data = FakeDisplayData()
+
+
+def make_labels(object_count, image_size, coverage):
+    '''Tile an image with square objects
+
+    object_count - the number of objects
+    image_size - the height and width of the image
+    coverage - the fraction of each object's tile that it fills
+    '''
+    cell = max(1, int(image_size / np.ceil(np.sqrt(object_count))))
+    columns = image_size // cell
+    i, j = np.mgrid[0:image_size, 0:image_size]
+    labels = (i // cell) * columns + (j // cell) + 1
+    side = max(1, int(cell * np.sqrt(coverage)))
+    labels[((i % cell) >= side) | ((j % cell) >= side) |
+           ((j // cell) >= columns) | (labels > object_count)] = 0
+    return labels.astype(np.int32)
+
+
+def make_workspace(object_count, image_size, group_count, coverage, seed):
+    '''Build a workspace with one measurement per classification'''
+    random_state = np.random.RandomState(seed)
+    measurements = FakeMeasurements()
+    for i in range(group_count):
+        values = random_state.uniform(size=object_count)
+        values[random_state.uniform(size=object_count) < .01] = np.nan
+        measurements.add_measurement(OBJECT_NAME, FEATURE_FORMAT % i, values)
+    measurements.add_measurement(cpmeas.IMAGE, LOW_THRESHOLD_FEATURE, .1)
+    objects = FakeObjects(make_labels(object_count, image_size, coverage))
+    return FakeWorkspace(measurements,
+                         FakeObjectSet({OBJECT_NAME: objects}),
+                         FakeImageSet())
+
+
+def make_module(group_count, bin_count, wants_images, render_method,
+                thread_count=1):
+    '''Build a module with evenly spaced, image-based classifications'''
+    module = dco.ClassifyObjects()
+    module.show_window = False
+    module.thread_count.value = thread_count
+    for i in range(group_count):
+        if i > 0:
+            module.add_single_measurement()
+        group = module.single_measurements[i]
+        group.object_name.value = OBJECT_NAME
+        group.measurement.value = FEATURE_FORMAT % i
+        group.bin_choice.value = dco.BC_EVEN
+        group.bin_count.value = bin_count
+        group.wants_image_based_low_threshold.value = True
+        group.low_threshold_measurement.value = LOW_THRESHOLD_FEATURE
+        group.wants_image_based_high_threshold.value = False
+        group.high_threshold.value = .9
+        group.wants_low_bin.value = True
+        group.wants_high_bin.value = True
+        group.wants_images.value = wants_images
+        group.image_name.value = "Classified%d" % i
+        group.render_method.value = render_method
+    return module
+
+
+def measure_memory(fn):
+    '''Run fn and return (peak bytes, bytes still allocated afterwards,
+    number of blocks still allocated afterwards)'''
+    gc.collect()
+    if tracemalloc is None:
+        fn()
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return peak, None, None
+    tracemalloc.start()
+    try:
+        fn()
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    allocations = sum(
+        [stat.count for stat in snapshot.statistics('filename')])
+    return peak, current, allocations
+
+
+def benchmark_run(object_count, bin_count, group_count, image_size,
+                  wants_images, render_method, thread_count, coverage,
+                  repeat, seed):
+    '''Time ClassifyObjects.run for one combination of parameters'''
+    module = make_module(group_count, bin_count, wants_images,
+                         render_method, thread_count)
+    workspace = make_workspace(object_count, image_size, group_count,
+                               coverage, seed)
+    # Compile the plans and fill the caches outside of the timings
+    module.prepare_run(workspace)
+    module.run(workspace)
+    workspace.measurements.write_count = 0
+    module.run(workspace)
+    write_count = workspace.measurements.write_count
+
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        module.run(workspace)
+        times.append(timeit.default_timer() - start)
+    peak, retained, allocations = measure_memory(
+        lambda: module.run(workspace))
+    return dict(
+        object_count=object_count, bin_count=bin_count,
+        group_count=group_count, image_size=image_size,
+        wants_images=wants_images, render_method=render_method,
+        thread_count=thread_count, coverage=coverage,
+        min_seconds=min(times), median_seconds=float(np.median(times)),
+        peak_bytes=peak, retained_bytes=retained, allocations=allocations,
+        measurement_writes=write_count)
+
+
+def benchmark_load(group_count, repeat):
+    '''Time loading and validating the settings of a module'''
+    module = make_module(group_count, 3, True, dco.RM_ALL)
+    setting_values = [setting.unicode_value for setting in module.settings()]
+    times = dict(load_seconds=[], validate_seconds=[], settings_seconds=[],
+                 visible_settings_seconds=[], measurement_columns_seconds=[],
+                 measurements_seconds=[])
+    for _ in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        module = dco.ClassifyObjects()
+        module.set_settings_from_values(
+            setting_values, dco.ClassifyObjects.variable_revision_number,
+            dco.ClassifyObjects.module_name)
+        times["load_seconds"].append(timeit.default_timer() - start)
+        for key, fn in (("validate_seconds",
+                         lambda: module.validate_module(None)),
+                        ("settings_seconds", module.settings),
+                        ("visible_settings_seconds",
+                         module.visible_settings),
+                        ("measurement_columns_seconds",
+                         lambda: module.get_measurement_columns(None)),
+                        ("measurements_seconds",
+                         lambda: [module.get_measurements(
+                             None, object_name, dco.M_CATEGORY)
+                             for object_name in (cpmeas.IMAGE, OBJECT_NAME,
+                                                 cpmeas.EXPERIMENT)])):
+            start = timeit.default_timer()
+            fn()
+            times[key].append(timeit.default_timer() - start)
+    result = dict(group_count=group_count,
+                  setting_count=len(setting_values))
+    for key, values in times.items():
+        result[key] = min(values)
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--objects", type=int, nargs="+",
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--bins", type=int, nargs="+", default=[2, 20, 200])
+    parser.add_argument("--groups", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--image-sizes", type=int, nargs="+",
+                        default=[1024, 4096])
+    parser.add_argument("--images", choices=["on", "off", "both"],
+                        default="both",
+                        help="whether classified images are retained")
+    parser.add_argument("--render-methods", nargs="+",
+                        choices=[dco.RM_ALL, dco.RM_OBJECTS],
+                        default=[dco.RM_ALL])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1],
+                        help="numbers of threads for rendering images")
+    parser.add_argument("--coverage", type=float, default=.25,
+                        help="fraction of each object's tile it fills")
+    parser.add_argument("--load-groups", type=int, nargs="*",
+                        default=[1, 10, 100, 1000],
+                        help="numbers of classifications for the settings "
+                        "load timings")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file for the results "
+                        "(default: standard output)")
+    options = parser.parse_args(args)
+
+    cpprefs.set_headless()
+    wants_images = dict(on=[True], off=[False], both=[False, True])[
+        options.images]
+    results = []
+    for (object_count, bin_count, group_count, image_size, images,
+         render_method, thread_count) in itertools.product(
+            options.objects, options.bins, options.groups,
+            options.image_sizes, wants_images, options.render_methods,
+            options.threads):
+        if object_count > image_size * image_size:
+            continue
+        if not images and (render_method != options.render_methods[0] or
+                           thread_count != options.threads[0]):
+            continue
+        result = benchmark_run(object_count, bin_count, group_count,
+                               image_size, images, render_method,
+                               thread_count, options.coverage,
+                               options.repeat, options.seed)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    load_results = []
+    for group_count in options.load_groups:
+        result = benchmark_load(group_count, options.repeat)
+        print(json.dumps(result), file=sys.stderr)
+        load_results.append(result)
+
+    report = dict(
+        benchmark="DynamicClassifyObjects.run",
+        timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(), numpy=np.__version__,
+        platform=platform.platform(), results=results,
+        load_results=load_results)
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, "w") as fd:
+            json.dump(report, fd, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,9 @@ in a classification bin and will not show up in the output image (shown
 in the module display window); in the object classification they will
 have a value of False for all bins. However, they are still counted in
 the total number of objects and hence are reflected in the
-classification percentages.</p>
+classification percentages. The module counts these objects and those
+whose values are below or above every bin for each image, so that they
+can be checked without classifying the objects again.</p>
 
 <h4>Available measurements</h4>
 <ul>
@@ -32,11 +34,17 @@ classification percentages.</p>
 into each bin.</li>
 <li><i>PctObjectsPerBin:</i> The percentage of total objects that are
 classified into each bin.</li>
+<li><i>NumObjectsBelowRange, NumObjectsAboveRange, NumObjectsNaN:</i>
+The number of objects outside of every bin because their value is at or
+below the lowest threshold, above the highest threshold, or missing.</li>
 </ul>
 </li>
 <li><b>Object measurements:</b>
 Single measurement: Classification (true/false) of the N<sup>th</sup>
 bin for the M<sup>th</sup> measurement.
+Joint classification: The number of the object's joint bin.
+Optionally, <i>NoBinReason:</i> why the object is outside of every bin,
+-1, -2 and -3 for the reasons above in order, or 0 for objects in a bin.
 </li>
 </ul>
 
@@ -56,27 +64,1322 @@ See also <b>CalculateMath</b> and any of the modules in the
 
 import cellprofiler.preferences as cpprefs
 
+import argparse
+import hashlib
+import itertools
+import multiprocessing.pool
+import os
+import shutil
+import tempfile
+import timeit
+import zipfile
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import numpy as np
 
 import cellprofiler.cpmodule as cpm
 import cellprofiler.measurements as cpmeas
 import cellprofiler.cpimage as cpi
+import cellprofiler.pipeline as cpp
 import cellprofiler.settings as cps
 from cellprofiler.settings import YES, NO
 
 
 BC_EVEN = "Evenly spaced bins"
 BC_CUSTOM = "Custom-defined bins"
+BC_QUANTILE = "Equal-frequency bins"
+
+IP_FLOAT64 = "64-bit floating point"
+IP_FLOAT32 = "32-bit floating point"
+IP_UINT8 = "8-bit integer"
+
+IT_COLOR = "Color"
+IT_BIN_LABELS = "Bin numbers"
+
+RM_ALL = "All pixels"
+RM_OBJECTS = "Object pixels only"
+
+OO_ONE_HOT = "One column per bin"
+OO_BIN_NUMBER = "Bin number column"
+
+DM_FULL = "Full size"
+DM_THUMBNAIL = "Thumbnail"
+DM_NONE = "None"
+
+# The largest height or width of the labels kept for a thumbnail display
+THUMBNAIL_SIZE = 512
+
+# The number of bars in the display's histogram of measurement values
+DISPLAY_HISTOGRAM_BINS = 10
+
+# Images with fewer pixels than this are rendered on a single thread
+PARALLEL_MIN_PIXELS = 1 << 20
+
+# The number of image sets whose measurements are read at a time when
+# classifying the measurements of an earlier run
+RECLASSIFY_CHUNK_SIZE = 1000
+
+# The folder of the result cache within the temporary directory, if the
+# user doesn't choose one
+RESULT_CACHE_FOLDER = "ClassifyObjectsCache"
+
+# The number of pipeline settings in each classification, by
+# variable revision number
+GROUP_SETTING_COUNTS = {1: 17, 2: 18, 3: 20, 4: 21, 5: 22, 6: 22, 7: 22,
+                        8: 23, 9: 27, 10: 27, 11: 27,
+                        12: 27, 13: 28}
 
 M_CATEGORY = "Classify"
 F_PCT_PER_BIN = 'PctObjectsPerBin'
 F_NUM_PER_BIN = 'NumObjectsPerBin'
+F_BIN_NUMBER = 'BinNumber'
+F_JOINT_BIN = 'JointBin'
+F_NUM_BELOW_RANGE = 'NumObjectsBelowRange'
+F_NUM_ABOVE_RANGE = 'NumObjectsAboveRange'
+F_NUM_NAN = 'NumObjectsNaN'
+F_NO_BIN_REASON = 'NoBinReason'
+
+# The most classifications that can be combined into a joint classification
+MAX_JOINT_MEASUREMENTS = 3
+
+# SQL column types narrower than cpmeas.COLTYPE_INTEGER for the per-object
+# measurements. MySQL and SQLite both accept them.
+COLTYPE_TINYINT = "tinyint"
+COLTYPE_SMALLINT = "smallint"
+
+# Experiment-wide statistics of the objects in each bin
+F_TOTAL_PER_BIN = 'TotalObjectsPerBin'
+F_MEAN_PER_BIN = 'MeanPerBin'
+F_STDEV_PER_BIN = 'StDevPerBin'
+F_STATISTICS_PER_BIN = (F_TOTAL_PER_BIN, F_MEAN_PER_BIN, F_STDEV_PER_BIN)
+# The image measurements of each bin that the statistics are combined from,
+# along with F_NUM_PER_BIN
+F_SUM_PER_BIN = 'SumPerBin'
+F_SUM_OF_SQUARES_PER_BIN = 'SumOfSquaresPerBin'
+
+# The bin index given to objects that do not fall into any bin, which
+# records why: the value is at or below the first bin edge, above the last
+# bin edge, or the value or the edges are NaN. Any negative bin index
+# means no bin. count_bins_and_reasons relies on the codes being -1 to -3.
+NB_BELOW = -1
+NB_ABOVE = -2
+NB_NAN = -3
+NO_BIN_REASONS = (NB_BELOW, NB_ABOVE, NB_NAN)
+# The image features counting the objects with each reason for no bin
+F_NO_BIN_COUNTS = (F_NUM_BELOW_RANGE, F_NUM_ABOVE_RANGE, F_NUM_NAN)
+
+# The steps of classifying a set of objects, in the order they run, and the
+# image measurements recording the time and memory taken by each
+S_FETCH = "Fetch"
+S_THRESHOLDS = "Thresholds"
+S_BINNING = "Binning"
+S_STATISTICS = "Statistics"
+S_WRITE = "Write"
+S_CACHE = "Cache"
+S_RENDER = "Render"
+S_DISPLAY = "Display"
+STAGES = (S_FETCH, S_THRESHOLDS, S_CACHE, S_BINNING, S_STATISTICS, S_WRITE,
+          S_RENDER, S_DISPLAY)
+F_TIMING = 'Timing'
+F_STAGE_SECONDS = 'Seconds'
+F_STAGE_BYTES = 'Bytes'
+
+
+def bin_values(values, thresholds):
+    '''Assign each value to the bin whose edges enclose it
+
+    values - a vector of measurement values, one per object
+    thresholds - the bin edges. Bin k is the right-closed interval
+                 (thresholds[k], thresholds[k+1]].
+
+    Returns a vector holding the zero-based bin index of each value. Values
+    outside of every bin get the code in NO_BIN_REASONS for why, see
+    get_no_bin_reasons.
+
+    thresholds can also hold one row of edges per object, see
+    bin_values_per_object.
+    '''
+    values = np.asarray(values, float)
+    thresholds = np.asarray(thresholds, float)
+    if thresholds.ndim > 1:
+        return bin_values_per_object(values, thresholds)
+    bin_count = len(thresholds) - 1
+    if bin_count < 1:
+        return np.zeros(len(values), int) + NB_NAN
+    if np.all(thresholds[1:] >= thresholds[:-1]):
+        #
+        # For sorted edges, the left insertion point of a value is one
+        # past the bin that holds it. Past an extra infinite edge, values
+        # above the last edge insert just before it and NaN, which sorts
+        # last, just after it, so that one lookup gives each value's bin
+        # or its reason for having none.
+        #
+        codes = np.hstack(([NB_BELOW], np.arange(bin_count),
+                           [NB_ABOVE, NB_NAN]))
+        return codes[np.searchsorted(np.hstack((thresholds, [np.inf])),
+                                     values, side='left')]
+    #
+    # Edges that are out of order (e.g. an image-based low threshold that
+    # exceeds the high threshold) can't be searched. Compare against one bin
+    # at a time so that we never hold more than one object vector.
+    #
+    bin_index = get_no_bin_reasons(values, thresholds[0], thresholds[-1])
+    for k in reversed(range(bin_count)):
+        bin_index[(values > thresholds[k]) &
+                  (values <= thresholds[k+1])] = k
+    return bin_index
+
+
+def bin_values_per_object(values, thresholds, rows=None):
+    '''Assign each value to a bin using its object's own bin edges
+
+    values - a vector of measurement values, one per object
+    thresholds - an array of rows of bin edges. The bins are the same as
+                 those of bin_values.
+    rows - the row of thresholds of each object or None if thresholds has
+           one row per object
+
+    Returns the zero-based bin index of each value, or its reason code for
+    having none as bin_values does. Objects without edges (all NaN) get
+    NB_NAN.
+    '''
+    values = np.asarray(values, float)
+    thresholds = np.asarray(thresholds, float)
+    bin_count = thresholds.shape[1] - 1
+    bin_index = np.zeros(len(values), int) + NB_NAN
+    if bin_count < 1:
+        return bin_index
+    bin_index[:] = -1
+    #
+    # As in bin_values, the number of sorted edges below a value is one
+    # past its bin. Count them one edge at a time to keep to a vector per
+    # object.
+    #
+    for k in range(bin_count + 1):
+        edge = thresholds[:, k]
+        if rows is not None:
+            edge = edge[rows]
+        bin_index += edge < values
+    outside = np.flatnonzero((bin_index < 0) | (bin_index >= bin_count))
+    outside_rows = outside if rows is None else rows[outside]
+    bin_index[outside] = get_no_bin_reasons(
+        values[outside], thresholds[outside_rows, 0],
+        thresholds[outside_rows, -1])
+    is_unsorted = ~np.all(thresholds[:, 1:] >= thresholds[:, :-1], 1)
+    if rows is not None:
+        is_unsorted = is_unsorted[rows]
+    unsorted = np.flatnonzero(is_unsorted)
+    if len(unsorted) > 0:
+        unsorted_values = values[unsorted]
+        if rows is None:
+            unsorted_thresholds = thresholds[unsorted]
+        else:
+            unsorted_thresholds = thresholds[rows[unsorted]]
+        bin_index[unsorted] = get_no_bin_reasons(
+            unsorted_values, unsorted_thresholds[:, 0],
+            unsorted_thresholds[:, -1])
+        for k in reversed(range(bin_count)):
+            bin_index[unsorted[
+                (unsorted_values > unsorted_thresholds[:, k]) &
+                (unsorted_values <= unsorted_thresholds[:, k+1])]] = k
+    return bin_index
+
+
+def get_no_bin_reasons(values, low_edges, high_edges):
+    '''Return the reason code of values that are outside of every bin
+
+    values - the values
+    low_edges, high_edges - the first and the last bin edge of each value,
+                            or of all of them
+
+    Values at or below the first edge get NB_BELOW, other values above the
+    last edge NB_ABOVE and the rest, which are NaN or have NaN edges,
+    NB_NAN. A value between the first and the last edge is always in some
+    bin, so these are the only reasons.
+    '''
+    reasons = np.zeros(len(values), int) + NB_NAN
+    reasons[values > high_edges] = NB_ABOVE
+    reasons[values <= low_edges] = NB_BELOW
+    return reasons
+
+
+# The number of entries in matplotlib's colormap lookup tables
+COLORMAP_LUT_SIZE = 256
+
+# The segment data of matplotlib's "jet" colormap, CellProfiler's default.
+# Headless workers use it to color images without importing matplotlib.
+BUILTIN_COLORMAPS = {
+    "jet": (
+        ((0.00, 0, 0), (0.35, 0, 0), (0.66, 1, 1), (0.89, 1, 1),
+         (1.00, 0.5, 0.5)),
+        ((0.000, 0, 0), (0.125, 0, 0), (0.375, 1, 1), (0.640, 1, 1),
+         (0.910, 0, 0), (1.000, 0, 0)),
+        ((0.00, 0.5, 0.5), (0.11, 1, 1), (0.34, 1, 1), (0.65, 0, 0),
+         (1.00, 0, 0)))}
+
+# Colors for labels images, keyed by (colormap name, number of bins)
+colormap_luts = {}
+
+
+def get_colormap_lut(colormap_name, count):
+    '''Return the colors used to draw a labels image with count bins
+
+    colormap_name - the name of the matplotlib colormap
+    count - the number of bins
+
+    Returns a read-only (count+1) x 4 array of RGBA colors. Row 0 is black
+    for the background and row k is the color of the k-th bin.
+    '''
+    key = (colormap_name, count)
+    lut = colormap_luts.get(key)
+    if lut is None:
+        lut = make_colormap_lut(colormap_name, count)
+        lut.flags.writeable = False
+        colormap_luts[key] = lut
+    return lut
+
+
+def make_colormap_lut(colormap_name, count):
+    '''Compute the colors for get_colormap_lut
+
+    matplotlib is only imported if the colormap isn't built in or if we
+    are not running headless. If it can't be imported, the "jet" colormap
+    is used.
+    '''
+    if colormap_name in BUILTIN_COLORMAPS and cpprefs.get_headless():
+        colors = builtin_colormap_colors(colormap_name, count)
+    else:
+        try:
+            import matplotlib.cm as cm
+        except ImportError:
+            colors = builtin_colormap_colors(
+                colormap_name if colormap_name in BUILTIN_COLORMAPS
+                else "jet", count)
+        else:
+            cmap = cm.get_cmap(colormap_name)
+            #
+            # Trick the colormap into divulging the values used.
+            #
+            sm = cm.ScalarMappable(cmap=cmap)
+            colors = sm.to_rgba(np.arange(count)+1)
+    return np.vstack((np.zeros(colors.shape[1]), colors))
+
+
+def builtin_colormap_colors(colormap_name, count):
+    '''Color the values 1 to count as matplotlib would, without matplotlib
+
+    This follows ScalarMappable.to_rgba: the values are scaled to the
+    range 0 - 1 and then looked up in a table built by interpolating the
+    colormap's segment data.
+    '''
+    n = COLORMAP_LUT_SIZE
+    xind = (n - 1) * np.linspace(0, 1, n)
+    table = np.ones((n, 4))
+    for channel, segment_data in enumerate(BUILTIN_COLORMAPS[colormap_name]):
+        segment_data = np.array(segment_data, float)
+        x = segment_data[:, 0] * (n - 1)
+        y0 = segment_data[:, 1]
+        y1 = segment_data[:, 2]
+        ind = np.searchsorted(x, xind)[1:-1]
+        distance = (xind[1:-1] - x[ind - 1]) / (x[ind] - x[ind - 1])
+        table[:, channel] = np.clip(np.hstack((
+            [y1[0]], distance * (y0[ind] - y1[ind - 1]) + y1[ind - 1],
+            [y0[-1]])), 0, 1)
+    if count > 1:
+        scaled = np.arange(count, dtype=float) / (count - 1)
+    else:
+        scaled = np.zeros(count)
+    index = (scaled * n).astype(int)
+    index[index == n] = n - 1
+    return table[index]
+
+
+def smallest_unsigned_dtype(max_value):
+    '''Return the narrowest unsigned integer type that holds max_value'''
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_value <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def bin_index_dtype(bin_count):
+    '''Return the narrowest integer type for the bin indexes of bin_count
+    bins and the codes in NO_BIN_REASONS'''
+    for dtype in (np.int8, np.int16, np.int32):
+        if bin_count <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def get_thumbnail_step(shape, size=THUMBNAIL_SIZE):
+    '''Return the stride that shrinks an image of the given shape so that
+    neither side is larger than size'''
+    return max(1, int(np.ceil(float(max(shape)) / size)))
+
+
+def take_rows(table, labels, out, pool=None, block_count=1):
+    '''Look up the table row of each label, writing the rows to out
+
+    table - an array with one row per label
+    labels - an array of indexes into the table, clipped to its size
+    out - an array of shape labels.shape + table.shape[1:] for the result
+    pool - a thread pool to look up blocks of rows of the labels in
+           parallel or None to do them all at once. np.take releases the
+           GIL, so the blocks are looked up at the same time.
+    block_count - the number of blocks to split the rows into
+
+    Returns out.
+    '''
+    if (pool is None or block_count <= 1 or
+            labels.size < PARALLEL_MIN_PIXELS):
+        np.take(table, labels, axis=0, out=out, mode='clip')
+        return out
+    row_count = labels.shape[0]
+    block_count = min(row_count, block_count)
+    edges = np.linspace(0, row_count, block_count + 1).astype(int)
+
+    def take_block(block):
+        start, stop = edges[block], edges[block + 1]
+        np.take(table, labels[start:stop], axis=0, out=out[start:stop],
+                mode='clip')
+    pool.map(take_block, range(block_count))
+    return out
+
+
+def scatter_pixels(shape, ijv, pixel_values, out=None):
+    '''Draw values at the object pixels of an otherwise blank image
+
+    shape - the i, j shape of the image
+    ijv - an array whose rows are the i, j and label of each object pixel
+    pixel_values - the value (or channel values) of each row of the ijv
+    out - a zeroed array to draw into or None to allocate one
+
+    Only the object pixels are touched after the background is zeroed.
+    '''
+    if out is None:
+        out = np.zeros(tuple(shape) + pixel_values.shape[1:],
+                       pixel_values.dtype)
+    out[ijv[:, 0], ijv[:, 1]] = pixel_values
+    return out
+
+
+def bin_number_coltype(bin_count):
+    '''Return the narrowest column type for bin numbers up to bin_count'''
+    if bin_count <= np.iinfo(np.int8).max:
+        return COLTYPE_TINYINT
+    if bin_count <= np.iinfo(np.int16).max:
+        return COLTYPE_SMALLINT
+    return cpmeas.COLTYPE_INTEGER
+
+
+def count_bins(bin_index, bin_count):
+    '''Count the number of objects in each bin
+
+    bin_index - the bin index of each object as returned by bin_values, or
+                a stack of these with one row per classification
+    bin_count - the number of bins or, for a stack, a sequence giving the
+                number of bins of each row
+
+    Returns the count per bin or, for a stack, a list of the counts per bin
+    of each row.
+    '''
+    return count_bins_and_reasons(bin_index, bin_count)[0]
+
+
+def count_bins_and_reasons(bin_index, bin_count):
+    '''Count the objects in each bin and those in no bin for each reason
+
+    bin_index, bin_count - as for count_bins
+
+    Returns the count per bin and the number of objects with each code in
+    NO_BIN_REASONS or, for a stack, a list of the counts per bin of each
+    row and an array with a row of the counts per reason of each row.
+    '''
+    #
+    # Shift the reason codes, -3 to -1, to the first three counts and each
+    # row's bins past those of the rows above it so that one bincount
+    # counts every bin and reason of every classification.
+    #
+    reason_count = len(NO_BIN_REASONS)
+    if np.ndim(bin_index) == 1:
+        counts = np.bincount(bin_index + reason_count,
+                             minlength=bin_count + reason_count)
+        return counts[reason_count:], counts[reason_count - 1::-1]
+    offsets = np.hstack(([0], np.cumsum(
+        np.asarray(bin_count, int) + reason_count))).astype(int)
+    counts = np.bincount(
+        (bin_index + (offsets[:-1] + reason_count)[:, np.newaxis]).ravel(),
+        minlength=offsets[-1])
+    return ([counts[offsets[i] + reason_count:offsets[i+1]]
+             for i in range(len(bin_count))],
+            np.vstack([counts[offsets[i]:offsets[i] + reason_count][::-1]
+                       for i in range(len(bin_count))]))
+
+
+def classify_experiment(values, image_index, thresholds, image_count=None):
+    '''Classify the objects of many image sets in one call
+
+    values - the measurement values of the objects of all image sets,
+             concatenated
+    image_index - the zero-based index of the image set of each object
+    thresholds - the bin edges shared by all image sets or an array with
+                 one row of edges per image set, for instance from
+                 BinPlan.get_image_thresholds
+    image_count - the number of image sets. Defaults to the number of rows
+                  of thresholds or one more than the largest image index.
+
+    Returns the bin index of each object (a negative reason code for objects
+    outside of every bin, see bin_values), the number of objects in each
+    bin of each image set as an image sets x bins array and the percentage
+    of the image set's objects in each bin, laid out the same way.
+    '''
+    values = np.asarray(values, float)
+    image_index = np.asarray(image_index, int)
+    thresholds = np.asarray(thresholds, float)
+    if image_count is None:
+        if thresholds.ndim > 1:
+            image_count = thresholds.shape[0]
+        else:
+            image_count = image_index.max() + 1 if len(image_index) > 0 else 0
+    if thresholds.ndim > 1:
+        bin_index = bin_values_per_object(values, thresholds, image_index)
+    else:
+        bin_index = bin_values(values, thresholds)
+    bin_count = max(thresholds.shape[-1] - 1, 0)
+    in_bin = bin_index >= 0
+    counts = np.bincount(
+        image_index[in_bin] * bin_count + bin_index[in_bin],
+        minlength=image_count * bin_count).reshape(image_count, bin_count)
+    object_counts = np.bincount(image_index, minlength=image_count)
+    percents = np.zeros(counts.shape)
+    has_objects = object_counts > 0
+    percents[has_objects] = (100.0 * counts[has_objects] /
+                             object_counts[has_objects, np.newaxis])
+    return bin_index, counts, percents
+
+
+def get_measurement(measurements, object_name, feature, image_set_number=None):
+    '''Get a measurement of the current image set or of the given one'''
+    if image_set_number is None:
+        return measurements.get_current_measurement(object_name, feature)
+    return measurements.get_measurement(object_name, feature, image_set_number)
+
+
+def get_quantile_cuts(values, bin_count):
+    '''Return the largest value in each equal-frequency bin but the last
+
+    values - the values of every object of the group, NaN for objects
+             without one
+    bin_count - the number of bins
+
+    Cut k is the ceil(k * n / bin_count)'th smallest of the n values that
+    aren't NaN. Values equal to a cut go in the bin below it.
+    '''
+    values = values[~np.isnan(values)]
+    if len(values) == 0 or bin_count <= 1:
+        return values[:0]
+    ranks = (np.arange(1, bin_count) * len(values) + bin_count - 1) // \
+        bin_count - 1
+    return np.partition(values, ranks)[ranks]
+
+
+def bin_quantile_values(values, cuts):
+    '''Assign values to equal-frequency bins
+
+    values - the values of the objects of one image set
+    cuts - the largest value in each bin but the last, as returned by
+           get_quantile_cuts
+
+    Returns the bin index of each object as bin_values would.
+    '''
+    bin_index = np.searchsorted(cuts, values, side='left')
+    bin_index[np.isnan(values)] = NB_NAN
+    return bin_index
+
+
+class BinStatistics(object):
+    '''The statistics of the objects in each bin of a classification
+
+    Each cycle records the number of objects in each bin and the sum and
+    the sum of squares of their values as image measurements. The
+    statistics are combined from those after the last cycle, in whichever
+    process holds the measurements of every image set, so no objects are
+    kept and the image sets can run in any process.
+    '''
+
+    def __init__(self, bin_count):
+        self.count = np.zeros(bin_count, int)
+        self.sum = np.zeros(bin_count)
+        self.sum_of_squares = np.zeros(bin_count)
+
+    @staticmethod
+    def get_sums(values, bin_index, bin_count):
+        '''Return the sum and the sum of squares of the values in each bin
+
+        values - the classified measurement of each object
+        bin_index - the bin index of each object as returned by bin_values
+        bin_count - the number of bins
+        '''
+        has_bin = bin_index >= 0
+        values = np.asarray(values, float)[has_bin]
+        bin_index = bin_index[has_bin]
+        return (np.bincount(bin_index, values, bin_count),
+                np.bincount(bin_index, values * values, bin_count))
+
+    def add(self, count, sums, sums_of_squares):
+        '''Add the number of objects in each bin and the sum and the sum of
+        squares of their values, of one or more image sets'''
+        self.count += np.asarray(count, int)
+        self.sum += sums
+        self.sum_of_squares += sums_of_squares
+
+    def get_mean(self):
+        '''The mean of each bin or NaN for empty bins'''
+        return np.where(self.count > 0,
+                        self.sum / np.maximum(self.count, 1), np.nan)
+
+    def get_std_dev(self):
+        '''The standard deviation of each bin or NaN for empty bins'''
+        count = np.maximum(self.count, 1)
+        mean = self.sum / count
+        variance = np.maximum(self.sum_of_squares / count - mean * mean, 0)
+        return np.where(self.count > 0, np.sqrt(variance), np.nan)
+
+
+class ResultCache(object):
+    '''A store on disk of classification results, keyed by a hash of their
+    inputs
+
+    Each entry is a .npz file of named arrays. When the files take more
+    than max_bytes, the least recently used ones are deleted. Several
+    processes can share a store.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # The bytes taken by the entries, counted on the first store
+        self.size = None
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        '''Return the arrays stored under a key or None if there are none'''
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            data = np.load(path)
+            try:
+                result = dict([(name, data[name]) for name in data.files])
+            finally:
+                data.close()
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, zipfile.BadZipfile):
+            # Removed by another process or only partly written
+            return None
+        return result
+
+    def put(self, key, arrays):
+        '''Store arrays, given as a dictionary of name to array, under a key
+        '''
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        #
+        # Write to a temporary file and rename it so that readers never see
+        # a partial entry
+        #
+        fd, temporary_path = tempfile.mkstemp(suffix=".tmp",
+                                              dir=self.directory)
+        with os.fdopen(fd, "wb") as temporary_file:
+            np.savez(temporary_file, **arrays)
+        path = self.get_path(key)
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            # Another process stored the same entry
+            os.remove(temporary_path)
+            return
+        if self.size is None:
+            self.evict()
+        else:
+            self.size += os.path.getsize(path)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        '''Delete the least recently used entries to fit in max_bytes'''
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum([size for _, size, _ in entries])
+        for _, size, path in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+def get_result_key(plans, values, thresholds):
+    '''Return a hash of the inputs of a classification of a set of objects
+
+    plans - a list of (index, plan) of the classifications
+    values - the measurement values of each classification
+    thresholds - the bin edges of each classification
+    '''
+    digest = hashlib.sha1()
+    digest.update(("%s:%d" % (ClassifyObjects.module_name,
+                              ClassifyObjects.variable_revision_number)
+                   ).encode("utf-8"))
+    for (_, plan), plan_values, plan_thresholds in zip(
+            plans, values, thresholds):
+        digest.update(plan.settings_key.encode("utf-8"))
+        for array in (plan_values, plan_thresholds):
+            array = np.ascontiguousarray(array, float)
+            digest.update(str(array.shape).encode("utf-8"))
+            digest.update(array)
+    return digest.hexdigest()
+
+
+def get_no_bin_features(measurement_name):
+    '''Return the image features counting a classification's objects
+    outside of every bin, without the category, in the order of
+    NO_BIN_REASONS'''
+    return ['_'.join((measurement_name, feature))
+            for feature in F_NO_BIN_COUNTS]
+
+
+class JointPlan(object):
+    '''The parts of a joint classification that are fixed by its settings
+
+    A joint classification puts each object in the bin for its combination
+    of bins in two or more classifications of the same objects. Joint bins
+    are numbered with the first classification's bin changing slowest.
+    '''
+
+    def __init__(self, indexes, plans):
+        '''Compile the plan for a joint classification
+
+        indexes - the position in single_measurements of each classification
+        plans - the BinPlan of each classification
+        '''
+        self.indexes = indexes
+        self.object_name = plans[0].object_name
+        self.dimensions = tuple([plan.bin_count for plan in plans])
+        self.bin_count = int(np.prod(self.dimensions))
+        self.measurement_name = '_'.join(
+            [plan.measurement_name for plan in plans])
+        self.feature_names = [
+            '_'.join(names) for names in itertools.product(
+                *[plan.feature_names for plan in plans])]
+        self.count_features = [
+            '_'.join((M_CATEGORY, feature_name, F_NUM_PER_BIN))
+            for feature_name in self.feature_names]
+        self.percent_features = [
+            '_'.join((M_CATEGORY, feature_name, F_PCT_PER_BIN))
+            for feature_name in self.feature_names]
+        self.wants_bin_numbers = True
+        self.bin_number_feature = '_'.join(
+            (M_CATEGORY, self.measurement_name, F_JOINT_BIN))
+        self.bin_number_dtype = smallest_unsigned_dtype(self.bin_count)
+        self.no_bin_features = [
+            '_'.join((M_CATEGORY, feature_name))
+            for feature_name in get_no_bin_features(self.measurement_name)]
+        self.wants_no_bin_reasons = False
+
+    def get_bin_index(self, bin_indexes):
+        '''Combine the bin indexes of the classifications
+
+        bin_indexes - the bin index of each object in each classification,
+                      in the order of self.indexes
+
+        Returns the joint bin index of each object. Objects outside of a bin
+        in any of the classifications get the lowest of their reason codes,
+        so that NaN outranks above the range, which outranks below it.
+        '''
+        bin_indexes = np.vstack(bin_indexes)
+        lowest = bin_indexes.min(0)
+        outside = lowest < 0
+        joint_index = np.ravel_multi_index(
+            np.maximum(bin_indexes, 0), self.dimensions)
+        joint_index[outside] = lowest[outside]
+        return joint_index
+
+
+class MeasurementBatch(object):
+    '''The measurements of one image set, gathered to be written together
+
+    The image measurements of all bins are gathered as lists of features
+    and values and the object measurements as 2-D blocks with one row per
+    feature, so that each classification's values are computed for all of
+    its bins at once rather than bin by bin. A classification's 0/1 bin
+    flags are kept as its objects' bin indexes and each bin's row is made
+    when it is written, so there is never more than one row of flags in
+    memory. flush() writes them.
+    '''
+
+    def __init__(self, measurements, image_set_number=None):
+        '''measurements - the measurements to write to
+        image_set_number - the image set to write to or None for the
+                           current one
+        '''
+        self.measurements = measurements
+        self.image_set_number = image_set_number
+        self.image_features = []
+        self.image_values = []
+        self.object_blocks = []
+        self.bin_flags = []
+
+    def add_image_measurements(self, feature_names, values):
+        '''Add one image measurement per feature
+
+        feature_names - the names of the features
+        values - a vector of the value of each feature
+        '''
+        self.image_features += feature_names
+        self.image_values += np.asarray(values).tolist()
+
+    def add_object_measurements(self, object_name, feature_names, block):
+        '''Add per-object measurements of several features
+
+        object_name - the name of the objects
+        feature_names - the names of the features
+        block - a 2-D array with the values of each feature in a row
+
+        Returns the number of bytes in the block.
+        '''
+        self.object_blocks.append((object_name, feature_names, block))
+        return block.nbytes
+
+    def add_bin_flags(self, object_name, feature_names, bin_index):
+        '''Add a 0/1 measurement per bin of whether each object is in it
+
+        object_name - the name of the objects
+        feature_names - the names of the features, one per bin
+        bin_index - the index of each object's bin, negative if in none
+
+        Returns the number of bytes the flags take when written.
+        '''
+        self.bin_flags.append((object_name, feature_names, bin_index))
+        return len(feature_names) * len(bin_index)
+
+    def flush(self):
+        '''Write the gathered measurements and start a new batch
+
+        CellProfiler's measurements are written one feature at a time, so
+        this is the only place that calls add_measurement.
+        '''
+        measurements = self.measurements
+        image_set_number = self.image_set_number
+        for object_name, feature_names, block in self.object_blocks:
+            for feature_name, values in zip(feature_names, block):
+                measurements.add_measurement(
+                    object_name, feature_name, values,
+                    image_set_number=image_set_number)
+        for object_name, feature_names, bin_index in self.bin_flags:
+            for k, feature_name in enumerate(feature_names):
+                measurements.add_measurement(
+                    object_name, feature_name,
+                    (bin_index == k).view(np.uint8),
+                    image_set_number=image_set_number)
+        for feature_name, value in zip(self.image_features,
+                                       self.image_values):
+            measurements.add_measurement(
+                cpmeas.IMAGE, feature_name, value,
+                image_set_number=image_set_number)
+        self.image_features = []
+        self.image_values = []
+        self.object_blocks = []
+        self.bin_flags = []
+
+
+class StageTimer(object):
+    '''Accumulates the time taken by each step of a classification and the
+    size of the arrays that it produced'''
+
+    def __init__(self):
+        self.seconds = dict([(stage, 0.0) for stage in STAGES])
+        self.nbytes = dict([(stage, 0) for stage in STAGES])
+        self.stage = None
+        self.start = None
+
+    def begin(self, stage):
+        '''Start timing a step'''
+        self.stage = stage
+        self.start = timeit.default_timer()
+
+    def end(self, *arrays):
+        '''Stop timing the current step
+
+        arrays - the arrays allocated by the step. Integers are taken as
+                 a count of bytes.
+        '''
+        self.seconds[self.stage] += timeit.default_timer() - self.start
+        for array in arrays:
+            if isinstance(array, np.ndarray):
+                self.nbytes[self.stage] += array.nbytes
+            elif array is not None:
+                self.nbytes[self.stage] += int(array)
+        self.stage = None
+
+    def add_measurements(self, measurements, object_name):
+        '''Record the time and bytes of every step as image measurements'''
+        for stage in STAGES:
+            measurements.add_measurement(
+                cpmeas.IMAGE,
+                get_stage_feature(object_name, stage, F_STAGE_SECONDS),
+                self.seconds[stage])
+            measurements.add_measurement(
+                cpmeas.IMAGE,
+                get_stage_feature(object_name, stage, F_STAGE_BYTES),
+                self.nbytes[stage])
+
+
+class NullStageTimer(object):
+    '''A StageTimer that records nothing, used when timing is off'''
+
+    def begin(self, stage):
+        pass
+
+    def end(self, *arrays):
+        pass
+
+    def add_measurements(self, measurements, object_name):
+        pass
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+
+def get_stage_feature(object_name, stage, unit, category=M_CATEGORY):
+    '''Return the image measurement holding a step's time or bytes
+
+    object_name - the objects being classified
+    stage - one of STAGES
+    unit - F_STAGE_SECONDS or F_STAGE_BYTES
+    category - the measurement category or None to leave it off
+    '''
+    parts = (F_TIMING, object_name, stage, unit)
+    if category is not None:
+        parts = (category,) + parts
+    return '_'.join(parts)
+
+
+class BinPlan(object):
+    '''The parts of a classification that are fixed by its settings
+
+    A plan is compiled once per revision of the module's settings so that
+    each cycle only has to look up the measurements that supply image-based
+    thresholds.
+    '''
+
+    def __init__(self, group, measurement_name):
+        '''Compile the plan for one classification
+
+        group - the classification's settings group
+        measurement_name - the name used for the measurement inside the bin
+                           feature names, see measurement_name()
+        '''
+        self.object_name = group.object_name.value
+        self.feature = group.measurement.value
+        self.measurement_name = measurement_name
+        #
+        # The settings of the classification as text, for the result cache
+        #
+        self.settings_key = u"\n".join(
+            [setting.unicode_value for setting in group.pipeline_settings()])
+        #
+        # The JointPlan of the joint classification that this
+        # classification completes, if any. See compile_bin_plans.
+        #
+        self.joint_plan = None
+        #
+        # Equal-frequency bins can only be chosen after every image set of
+        # the group has been seen, so there is no image to retain.
+        #
+        self.is_quantile = group.bin_choice == BC_QUANTILE
+        self.wants_images = (bool(group.wants_images.value) and
+                             not self.is_quantile)
+        self.image_name = group.image_name.value
+        self.wants_statistics = group.wants_statistics()
+        self.image_precision = group.image_precision.value
+        self.image_type = group.image_type.value
+        self.render_method = group.render_method.value
+        self.feature_names = group.bin_feature_names(measurement_name)
+        self.object_features = ['_'.join((M_CATEGORY, feature_name))
+                                for feature_name in self.feature_names]
+        self.count_features = [
+            '_'.join((M_CATEGORY, feature_name, F_NUM_PER_BIN))
+            for feature_name in self.feature_names]
+        self.percent_features = [
+            '_'.join((M_CATEGORY, feature_name, F_PCT_PER_BIN))
+            for feature_name in self.feature_names]
+        self.wants_bin_numbers = group.object_output == OO_BIN_NUMBER
+        self.bin_number_feature = '_'.join(
+            (M_CATEGORY, measurement_name, F_BIN_NUMBER))
+        self.no_bin_features = [
+            '_'.join((M_CATEGORY, feature_name))
+            for feature_name in get_no_bin_features(measurement_name)]
+        self.wants_no_bin_reasons = bool(group.wants_no_bin_reasons.value)
+        self.no_bin_reason_feature = '_'.join(
+            (M_CATEGORY, measurement_name, F_NO_BIN_REASON))
+        self.sum_features = [
+            '_'.join((M_CATEGORY, feature_name, F_SUM_PER_BIN))
+            for feature_name in self.feature_names]
+        self.sum_of_squares_features = [
+            '_'.join((M_CATEGORY, feature_name, F_SUM_OF_SQUARES_PER_BIN))
+            for feature_name in self.feature_names]
+        self.statistics_features = dict([
+            (statistic, ['_'.join((M_CATEGORY, feature_name, statistic))
+                         for feature_name in self.feature_names])
+            for statistic in F_STATISTICS_PER_BIN])
+        self.low_edge = [-np.inf] if group.wants_low_bin else []
+        self.high_edge = [np.inf] if group.wants_high_bin else []
+        self.low_threshold_measurement = None
+        self.high_threshold_measurement = None
+        self.parent_name = None
+        if group.bin_choice == BC_EVEN:
+            self.even_bin_count = group.bin_count.value
+            self.low_threshold = group.low_threshold.value
+            self.high_threshold = group.high_threshold.value
+            if group.wants_parent_thresholds:
+                self.parent_name = group.parent_name.value
+                self.low_threshold_measurement = \
+                    group.low_parent_measurement.value
+                self.high_threshold_measurement = \
+                    group.high_parent_measurement.value
+            else:
+                if group.wants_image_based_low_threshold:
+                    self.low_threshold_measurement = \
+                        group.low_threshold_measurement.value
+                if group.wants_image_based_high_threshold:
+                    self.high_threshold_measurement = \
+                        group.high_threshold_measurement.value
+            self.bin_count = (self.even_bin_count + len(self.low_edge) +
+                              len(self.high_edge))
+            if self.is_dynamic():
+                self.thresholds = None
+            else:
+                self.thresholds = self.even_thresholds(
+                    self.low_threshold, self.high_threshold)
+        elif self.is_quantile:
+            self.bin_count = group.bin_count.value
+            self.thresholds = None
+        else:
+            self.thresholds = np.hstack((
+                self.low_edge,
+                [float(x.strip())
+                 for x in group.custom_thresholds.value.split(",")],
+                self.high_edge))
+            self.bin_count = len(self.thresholds) - 1
+        self.bin_number_dtype = smallest_unsigned_dtype(self.bin_count)
+        #
+        # The colormap rows and the RGB lookup table for the classified
+        # image are filled in the first time they are needed
+        #
+        self.colors = None
+        self.image_lut = None
+
+    def get_image_lut(self, colors):
+        '''Return the RGB color of each bin in the output image's type
+
+        colors - the colormap rows, as returned by get_colors
+        '''
+        if self.image_lut is None:
+            rgb = colors[:, :3]
+            if self.image_precision == IP_UINT8:
+                self.image_lut = (rgb * 255 + .5).astype(np.uint8)
+            elif self.image_precision == IP_FLOAT32:
+                self.image_lut = rgb.astype(np.float32)
+            else:
+                self.image_lut = np.ascontiguousarray(rgb)
+        return self.image_lut
+
+    def is_dynamic(self):
+        '''True if either threshold comes from a measurement of the image or
+        of the parent objects'''
+        return (self.low_threshold_measurement is not None or
+                self.high_threshold_measurement is not None)
+
+    def even_thresholds(self, low_threshold, high_threshold):
+        '''Return the edges of evenly spaced bins between two thresholds
+
+        The thresholds can be vectors with one value per object, giving one
+        row of edges per object.
+        '''
+        bin_count = self.even_bin_count
+        low_threshold = np.asarray(low_threshold, float)[..., np.newaxis]
+        high_threshold = np.asarray(high_threshold, float)[..., np.newaxis]
+        thresholds = (np.arange(bin_count+1) *
+                      (high_threshold - low_threshold)/float(bin_count) +
+                      low_threshold)
+        #
+        # Put infinities at either end of the thresholds so we can bin the
+        # low and high bins
+        #
+        shape = thresholds.shape[:-1]
+        return np.concatenate((
+            np.zeros(shape + (len(self.low_edge),)) + self.low_edge,
+            thresholds,
+            np.zeros(shape + (len(self.high_edge),)) + self.high_edge),
+            axis=-1)
+
+    def get_parent_values(self, measurements, feature, parents,
+                          image_set_number=None):
+        '''Give each object the value of its parent's measurement
+
+        measurements - the measurements for the current image set
+        feature - the parent objects' measurement
+        parents - the parent object number of each object, 0 for none
+        image_set_number - the image set or None for the current one
+
+        Objects without a parent get NaN.
+        '''
+        parent_values = get_measurement(
+            measurements, self.parent_name, feature, image_set_number)
+        if parent_values is None:
+            parent_values = np.zeros(0)
+        parent_values = np.hstack(([np.nan], parent_values))
+        parents = parents.copy()
+        parents[(parents < 0) | (parents >= len(parent_values))] = 0
+        return parent_values[parents]
+
+    def get_image_thresholds(self, low_thresholds=None, high_thresholds=None):
+        '''Return the bin edges of many image sets at once
+
+        low_thresholds - the value of the low threshold's image measurement
+                         in each image set, if the threshold is image-based
+        high_thresholds - the same for the high threshold
+
+        Returns the edges shared by every image set if they don't depend on
+        the image, otherwise one row of edges per image set. See
+        classify_experiment.
+        '''
+        if self.thresholds is not None:
+            return self.thresholds
+        if self.is_quantile or self.parent_name is not None:
+            raise ValueError(
+                "The bin edges of %s don't come from image measurements" %
+                self.feature)
+        if self.low_threshold_measurement is None:
+            low_thresholds = self.low_threshold
+        if self.high_threshold_measurement is None:
+            high_thresholds = self.high_threshold
+        return self.even_thresholds(low_thresholds, high_thresholds)
+
+    def get_thresholds(self, measurements, image_set_number=None):
+        '''Return the bin edges for the current cycle
+
+        measurements - the measurements for the current image set
+        image_set_number - the image set or None for the current one
+        '''
+        if self.thresholds is not None:
+            return self.thresholds
+        if self.parent_name is not None:
+            parents = get_measurement(
+                measurements, self.object_name,
+                cpmeas.FF_PARENT % self.parent_name, image_set_number)
+            if parents is None:
+                parents = np.zeros(0, int)
+            parents = np.asarray(parents).astype(int)
+            return self.even_thresholds(
+                self.get_parent_values(
+                    measurements, self.low_threshold_measurement, parents,
+                    image_set_number),
+                self.get_parent_values(
+                    measurements, self.high_threshold_measurement, parents,
+                    image_set_number))
+        if self.low_threshold_measurement is None:
+            low_threshold = self.low_threshold
+        else:
+            low_threshold = get_measurement(
+                measurements, cpmeas.IMAGE, self.low_threshold_measurement,
+                image_set_number)
+        if self.high_threshold_measurement is None:
+            high_threshold = self.high_threshold
+        else:
+            high_threshold = get_measurement(
+                measurements, cpmeas.IMAGE, self.high_threshold_measurement,
+                image_set_number)
+        return self.even_thresholds(low_threshold, high_threshold)
+
+
+def get_image_object_name():
+    '''The object name of the image measurements used as thresholds'''
+    return cpmeas.IMAGE
+
+
+class ClassificationGroup(cps.SettingsGroup):
+    '''The settings of one of ClassifyObjects' single measurements
+
+    The settings' callbacks are bound methods of the group rather than
+    closures, which keeps groups cheap to build for pipelines with hundreds
+    of classifications.
+    '''
+
+    def __init__(self, module, can_delete=True):
+        '''module - the ClassifyObjects module holding the group
+        can_delete - True if the group has a "remove" button
+        '''
+        cps.SettingsGroup.__init__(self)
+        self.module = module
+        self.can_delete = can_delete
+
+    def get_object_name(self):
+        return self.object_name.value
+
+    def get_parent_name(self):
+        return self.parent_name.value
+
+    def get_min_upper_threshold(self):
+        return self.low_threshold.value + np.finfo(float).eps
+
+    def wants_statistics(self):
+        '''True if per-bin statistics are recorded, which equal-frequency
+        bins can't have'''
+        return (bool(self.wants_bin_statistics.value) and
+                self.bin_choice != BC_QUANTILE)
+
+    def wants_joint(self):
+        '''True if the group is classified jointly with the one above it,
+        which equal-frequency bins can't be'''
+        return (bool(self.wants_joint_classification.value) and
+                self.bin_choice != BC_QUANTILE)
+
+    def number_of_bins(self):
+        '''Return the # of bins in this classification'''
+        if self.bin_choice == BC_QUANTILE:
+            return self.bin_count.value
+        if self.bin_choice == BC_EVEN:
+            value = self.bin_count.value
+        else:
+            value = len(self.custom_thresholds.value.split(","))-1
+        if self.wants_low_bin:
+            value += 1
+        if self.wants_high_bin:
+            value += 1
+        return value
+
+    def measurement_name(self):
+        '''Get the measurement name to use inside the bin name
+
+        Account for conflicts with previous measurements
+        '''
+        measurement_name = self.measurement.value
+        other_same = 0
+        for other in self.module.single_measurements:
+            if id(other) == id(self):
+                break
+            if other.measurement.value == measurement_name:
+                other_same += 1
+        if other_same > 0:
+            measurement_name += str(other_same)
+        return measurement_name
+
+    def bin_feature_names(self, base_name=None):
+        '''Return the feature names for each bin
+
+        base_name - the measurement name to use in the bin names if
+                    already known. Defaults to measurement_name().
+        '''
+        if self.wants_custom_names:
+            return [name.strip()
+                    for name in self.bin_names.value.split(",")]
+        if base_name is None:
+            base_name = self.measurement_name()
+        return ['_'.join((base_name, 'Bin_%d' % (i+1)))
+                for i in range(self.number_of_bins())]
+
+    def validate_group(self, measurement_name=None, index=None,
+                       joint_classifications=None):
+        '''Check the group's settings
+
+        measurement_name - the group's measurement_name() if already known
+        index - the group's index in the module's single measurements if
+                already known
+        joint_classifications - the module's get_joint_classifications()
+                                if already known
+        '''
+        bin_feature_names = self.bin_feature_names(measurement_name)
+        bin_name_count = len(bin_feature_names)
+        bin_count = self.number_of_bins()
+        if bin_count < 1:
+            bad_setting = (self.custom_thresholds
+                           if self.bin_choice == BC_CUSTOM
+                           else self.bin_count)
+            raise cps.ValidationError(
+                """You must have at least one bin in order to take
+                measurements.  Either add more bins or ask for bins
+                for objects above or below threshold""",
+                bad_setting)
+        if bin_name_count != bin_count:
+            raise cps.ValidationError(
+                "The number of bin names (%d) does not match the"
+                "number of bins (%d)." %
+                (bin_name_count, bin_count), self.bin_names)
+        for bin_feature_name in bin_feature_names:
+            cps.AlphanumericText.validate_alphanumeric_text(
+                bin_feature_name, self.bin_names, True)
+        if self.bin_choice == BC_CUSTOM:
+            try:
+                [float(x.strip())
+                 for x in self.custom_thresholds.value.split(",")]
+            except ValueError:
+                raise cps.ValidationError(
+                    'Custom thresholds must be a comma-separated list '
+                    'of numbers (example: "1.0, 2.3, 4.5")',
+                    self.custom_thresholds)
+        if self.wants_joint():
+            single_measurements = self.module.single_measurements
+            if index is None:
+                index = single_measurements.index(self)
+            if index == 0:
+                return
+            joined = single_measurements[index - 1]
+            if joined.object_name != self.object_name.value:
+                raise cps.ValidationError(
+                    "A joint classification must classify the same "
+                    "objects as the classification above it (%s)" %
+                    joined.object_name.value,
+                    self.wants_joint_classification)
+            if joined.bin_choice == BC_QUANTILE:
+                raise cps.ValidationError(
+                    "%s can't be used in a joint classification" %
+                    BC_QUANTILE, self.wants_joint_classification)
+            if joint_classifications is None:
+                joint_classifications = \
+                    self.module.get_joint_classifications()
+            for chain in joint_classifications:
+                if index in chain and len(chain) > MAX_JOINT_MEASUREMENTS:
+                    raise cps.ValidationError(
+                        "A joint classification can combine at most "
+                        "%d classifications" % MAX_JOINT_MEASUREMENTS,
+                        self.wants_joint_classification)
 
 
 class ClassifyObjects(cpm.CPModule):
     category = "Object Processing"
     module_name = "DynamicClassifyObjects"
-    variable_revision_number = 1
+    variable_revision_number = 13
 
     def create_settings(self):
         """Create the settings for the module
@@ -88,6 +1391,28 @@ class ClassifyObjects(cpm.CPModule):
         # to be done
         self.single_measurements = []
 
+        # Scratch space for the labels of the rendered classifications,
+        # reused from cycle to cycle
+        self.label_buffer = None
+
+        # For each classification with equal-frequency bins, by index, a
+        # list of the image number and object values of each image set of
+        # the current group
+        self.quantile_buffers = {}
+
+        # The compiled BinPlan of each single measurement or None if
+        # the settings have changed since they were compiled
+        self.bin_plans = None
+
+        # The ResultCache, created the first time that it is used
+        self.result_cache = None
+
+        # The threads that render images, created the first time that
+        # they are used and stopped at the end of the group, and their
+        # number
+        self.thread_pool = None
+        self.thread_pool_size = 0
+
         # A count of # of measurements
         self.single_measurement_count = cps.HiddenCount(
             self.single_measurements)
@@ -99,13 +1424,126 @@ class ClassifyObjects(cpm.CPModule):
         self.add_measurement_button = cps.DoSomething(
             "", "Add another classification", self.add_single_measurement)
 
+        self.stage_timing_divider = cps.Divider(line=True)
+
+        self.wants_stage_timing = cps.Binary(
+            "Record the time taken by each step?", False, doc="""
+            Select <i>%(YES)s</i> to time each step of classifying each set
+            of objects and record the times as image measurements, to find
+            out where a slow pipeline spends its time. For each set of
+            objects and each step, the module records the time taken in
+            <i>%(M_CATEGORY)s_%(F_TIMING)s_&lt;objects&gt;_&lt;step&gt;_
+            %(F_STAGE_SECONDS)s</i> and the size of the arrays that the step
+            produced in <i>%(M_CATEGORY)s_%(F_TIMING)s_&lt;objects&gt;_
+            &lt;step&gt;_%(F_STAGE_BYTES)s</i>. The steps are:
+            <ul>
+            <li><i>%(S_FETCH)s:</i> Getting the objects and their
+            measurements.</li>
+            <li><i>%(S_THRESHOLDS)s:</i> Finding the bin edges.</li>
+            <li><i>%(S_CACHE)s:</i> Looking up and storing results in the
+            result cache.</li>
+            <li><i>%(S_BINNING)s:</i> Assigning objects to bins and counting
+            them.</li>
+            <li><i>%(S_STATISTICS)s:</i> Accumulating per-bin statistics.</li>
+            <li><i>%(S_WRITE)s:</i> Writing the measurements.</li>
+            <li><i>%(S_RENDER)s:</i> Drawing the classified images.</li>
+            <li><i>%(S_DISPLAY)s:</i> Keeping the data shown in the module
+            display window.</li>
+            </ul>
+            Classifications of the same objects are done together, so their
+            steps are timed together. Select <i>%(NO)s</i> for no timing
+            overhead.""" % globals())
+
+        self.display_mode = cps.Choice(
+            "Data kept for the display window",
+            [DM_THUMBNAIL, DM_FULL, DM_NONE], doc="""
+            <i>(Used only if the module display window is shown)</i><br>
+            Choose how much data is sent to the display window. This data
+            is collected on every cycle while the window is shown and, when
+            running with several workers, is passed back from each of them.
+            <ul>
+            <li><i>%(DM_THUMBNAIL)s:</i> Keep labels shrunk so that
+            neither side is larger than %(THUMBNAIL_SIZE)d pixels.</li>
+            <li><i>%(DM_FULL)s:</i> Keep the labels at full size.</li>
+            <li><i>%(DM_NONE)s:</i> Keep nothing, skipping all of the work
+            done for the display. Use this for pipelines that are run on a
+            cluster or in batch mode, in case the window is left on.</li>
+            </ul>""" % globals())
+
+        self.wants_tiled_rendering = cps.Binary(
+            "Render images in tiles?", False, doc="""
+            Select <i>%(YES)s</i> to color the classified images a block of
+            rows at a time, for example for stitched slides whose label
+            matrix is larger than memory. The scratch space then depends
+            on the size of a tile rather than that of the image. Select
+            <i>%(NO)s</i> to color the whole image at once, which is a
+            little faster for ordinary images.""" % globals())
+
+        self.tile_rows = cps.Integer(
+            "Rows per tile", 1024, minval=1, doc="""
+            <i>(Used only if rendering images in tiles)</i><br>
+            Enter the number of rows of the image to color at a time.""")
+
+        self.wants_memmap_images = cps.Binary(
+            "Store classified images in temporary files?", False, doc="""
+            Select <i>%(YES)s</i> to write the classified images to files
+            in the temporary directory (see the preferences) that are
+            mapped into memory, so that the operating system can keep them
+            on disk. Use this
+            with tiled rendering for images that would not fit in memory.
+            The files are deleted when the images are no longer
+            used.""" % globals())
+
+        self.wants_result_cache = cps.Binary(
+            "Reuse the results of earlier runs?", False, doc="""
+            Select <i>%(YES)s</i> to keep the results of each image set in a
+            cache on disk and reuse them when the pipeline is run again on
+            objects with the same measurements and thresholds, with the
+            same classification settings. This saves time when rerunning a
+            pipeline where most images have not changed. The measurements
+            are still recorded for every image set.""" % globals())
+
+        self.cache_directory = cps.Text(
+            "Result cache folder", "", doc="""
+            <i>(Used only if reusing results)</i><br>
+            Enter the folder that holds the cache. Leave this blank to use
+            the folder <i>%(RESULT_CACHE_FOLDER)s</i> in the temporary
+            directory (see the preferences). Workers can share the
+            folder.""" % globals())
+
+        self.cache_size = cps.Integer(
+            "Largest size of the result cache (MB)", 1024, minval=1, doc="""
+            <i>(Used only if reusing results)</i><br>
+            Enter the most space that the cache can take. The results used
+            least recently are deleted when the cache grows larger.""")
+
+        self.wants_cached_images = cps.Binary(
+            "Reuse classified images?", False, doc="""
+            <i>(Used only if reusing results)</i><br>
+            Select <i>%(YES)s</i> to also keep the classified images in the
+            cache. An image is only reused if the objects' label matrix is
+            also unchanged, and not while the module display window is
+            shown. Images can take a lot of space, so use this when
+            rendering them is slow.""" % globals())
+
+        self.thread_count = cps.Integer(
+            "Number of threads for rendering images", 1, minval=1, doc="""
+            Choose how many threads draw the classified images. Each image
+            is split into blocks of rows that are colored at the same
+            time. Use more than one thread on computers with many cores
+            that classify few, very large images. Images smaller than
+            %(PARALLEL_MIN_PIXELS)d pixels are always drawn on one
+            thread. Measurements are recorded in the same order and are
+            the same whatever the number of threads.""" % globals())
+
     def add_single_measurement(self, can_delete=True):
         '''Add a single measurement to the group of single measurements
 
         can_delete - True to include a "remove" button, False if you're not
                      allowed to remove it.
         '''
-        group = cps.SettingsGroup()
+        self.invalidate_bin_plans()
+        group = ClassificationGroup(self, can_delete)
         if can_delete:
             group.append("divider", cps.Divider(line=True))
 
@@ -116,17 +1554,16 @@ class ClassifyObjects(cpm.CPModule):
             <b>IdentifyPrimaryObjects</b>, <b>IdentifySecondaryObjects</b>, or
             <b>IdentifyTertiaryObjects</b>."""))
 
-        def object_fn():
-            return group.object_name.value
         group.append("measurement", cps.Measurement(
-            "Select the measurement to classify by", object_fn, doc="""
+            "Select the measurement to classify by", group.get_object_name,
+            doc="""
             Select a measurement made by a previous module. The objects
             will be classified according to their values for this
             measurement."""))
 
         group.append("bin_choice", cps.Choice(
             "Select bin spacing",
-            [BC_EVEN, BC_CUSTOM], doc="""
+            [BC_EVEN, BC_CUSTOM, BC_QUANTILE], doc="""
             You can either specify bins of equal size, bounded by
             upper and lower limits, or you can specify custom values that
             define the edges of each bin with a threshold.
@@ -137,7 +1574,13 @@ class ClassifyObjects(cpm.CPModule):
             <i>Evenly spaced bins</i> creates the indicated number of bins
             at evenly spaced intervals between the low and high threshold.
             You also have the option to create bins for objects that fall below
-            or above the low and high threhsold"""))
+            or above the low and high threhsold
+            <p><i>%(BC_QUANTILE)s</i> chooses the edges so that each bin
+            holds the same share of the objects across all image sets of the
+            group (or the whole experiment if images are not grouped). The
+            objects are classified in the same run, after the last image
+            set of the group, so no image of the classified objects can be
+            retained.</p>""" % globals()))
 
         group.append("bin_count", cps.Integer(
             "Number of bins", 3, minval=1, doc="""
@@ -154,10 +1597,9 @@ class ClassifyObjects(cpm.CPModule):
 
         group.append("top_threshold_divider", cps.Divider(line=True))
 
-        def object_fn():
-            return cpmeas.IMAGE
         group.append('low_threshold_measurement', cps.Measurement(
-            "Measurement to use for low threshold", object_fn, doc="""
+            "Measurement to use for low threshold", get_image_object_name,
+            doc="""
             Choose the measurement to use in determining the low
             threshold value. This must be a measurement made by some
             previous module on the whole image."""))
@@ -176,9 +1618,6 @@ class ClassifyObjects(cpm.CPModule):
             whose values fall below the low threshold. Select <i>%(NO)s</i>
             if you do not want a bin for these objects.""" % globals()))
 
-        def min_upper_threshold():
-            return group.low_threshold.value + np.finfo(float).eps
-
         group.append("middle_threshold_divider", cps.Divider(line=True))
 
         group.append("wants_image_based_high_threshold", cps.Binary(
@@ -188,17 +1627,17 @@ class ClassifyObjects(cpm.CPModule):
             <p>Select <i>%(NO)s</i> to specify a single threshold value
             that will be used for each image.""" % globals()))
 
-        def object_fn():
-            return cpmeas.IMAGE
         group.append('high_threshold_measurement', cps.Measurement(
-            "Measurement to use for high threshold", object_fn, doc="""
+            "Measurement to use for high threshold", get_image_object_name,
+            doc="""
             Choose the measurement to use in determining the high
             threshold value. This must be a measurement made by some
             previous module on the whole image."""))
 
         group.append("high_threshold", cps.Float(
             "Upper threshold", 1,
-            minval=cps.NumberConnector(min_upper_threshold), doc="""
+            minval=cps.NumberConnector(group.get_min_upper_threshold),
+            doc="""
             <i>(Used only if Evenly spaced bins selected)</i><br> This
             is the threshold that separates the last bin from the
             others. <i>Note:</i> If you would like two bins, choose
@@ -249,76 +1688,149 @@ class ClassifyObjects(cpm.CPModule):
             Enter the name to be given to the classified object
             image."""))
 
-        group.can_delete = can_delete
-
-        def number_of_bins():
-            '''Return the # of bins in this classification'''
-            if group.bin_choice == BC_EVEN:
-                value = group.bin_count.value
-            else:
-                value = len(group.custom_thresholds.value.split(","))-1
-            if group.wants_low_bin:
-                value += 1
-            if group.wants_high_bin:
-                value += 1
-            return value
-        group.number_of_bins = number_of_bins
-
-        def measurement_name():
-            '''Get the measurement name to use inside the bin name
-
-            Account for conflicts with previous measurements
-            '''
-            measurement_name = group.measurement.value
-            other_same = 0
-            for other in self.single_measurements:
-                if id(other) == id(group):
-                    break
-                if other.measurement.value == measurement_name:
-                    other_same += 1
-            if other_same > 0:
-                measurement_name += str(other_same)
-            return measurement_name
-
-        def bin_feature_names():
-            '''Return the feature names for each bin'''
-            if group.wants_custom_names:
-                return [name.strip()
-                        for name in group.bin_names.value.split(",")]
-            return ['_'.join((measurement_name(),
-                              'Bin_%d' % (i+1)))
-                    for i in range(number_of_bins())]
-        group.bin_feature_names = bin_feature_names
-
-        def validate_group():
-            bin_name_count = len(bin_feature_names())
-            bin_count = number_of_bins()
-            if bin_count < 1:
-                bad_setting = (group.bin_count if group.bin_choice == BC_EVEN
-                               else group.custom_thresholds)
-                raise cps.ValidationError(
-                    """You must have at least one bin in order to take
-                    measurements.  Either add more bins or ask for bins
-                    for objects above or below threshold""",
-                    bad_setting)
-            if bin_name_count != number_of_bins():
-                raise cps.ValidationError(
-                    "The number of bin names (%d) does not match the"
-                    "number of bins (%d)." %
-                    (bin_name_count, bin_count), group.bin_names)
-            for bin_feature_name in bin_feature_names():
-                cps.AlphanumericText.validate_alphanumeric_text(
-                    bin_feature_name, group.bin_names, True)
-            if group.bin_choice == BC_CUSTOM:
-                try:
-                    [float(x.strip())
-                     for x in group.custom_thresholds.value.split(",")]
-                except ValueError:
-                    raise cps.ValidationError(
-                        'Custom thresholds must be a comma-separated list '
-                        'of numbers (example: "1.0, 2.3, 4.5")',
-                        group.custom_thresholds)
-        group.validate_group = validate_group
+        group.append("image_precision", cps.Choice(
+            "Output image precision", [IP_FLOAT64, IP_FLOAT32, IP_UINT8],
+            doc="""
+            <i>(Used only if retaining an image of the classified
+            objects)</i><br>
+            Choose the data type of the classified image. Smaller types
+            take less memory and are faster to produce.
+            <ul>
+            <li><i>%(IP_FLOAT64)s:</i> Colors are stored as 64-bit
+            floating point values between 0 and 1.</li>
+            <li><i>%(IP_FLOAT32)s:</i> Colors are stored as 32-bit
+            floating point values between 0 and 1, using half of the
+            memory.</li>
+            <li><i>%(IP_UINT8)s:</i> Colors are stored as integers between
+            0 and 255, using one eighth of the memory. Use this for an image
+            that will only be saved or displayed, since modules that expect
+            values between 0 and 1 will not work with it.</li>
+            </ul>""" % globals()))
+
+        group.append("image_type", cps.Choice(
+            "Output image type", [IT_COLOR, IT_BIN_LABELS], doc="""
+            <i>(Used only if retaining an image of the classified
+            objects)</i><br>
+            <ul>
+            <li><i>%(IT_COLOR)s:</i> Each object is colored according to
+            its bin.</li>
+            <li><i>%(IT_BIN_LABELS)s:</i> Each object's pixels hold the
+            number of its bin and the background is zero. This image is a
+            single channel of small integers and is much smaller than the
+            color image.</li>
+            </ul>""" % globals()))
+
+        group.append("render_method", cps.Choice(
+            "Pixels to render", [RM_ALL, RM_OBJECTS], doc="""
+            <i>(Used only if retaining an image of the classified
+            objects)</i><br>
+            <ul>
+            <li><i>%(RM_ALL)s:</i> Look up the classification of every pixel
+            in the objects' label matrix.</li>
+            <li><i>%(RM_OBJECTS)s:</i> Only draw the pixels that belong to
+            an object, starting from a blank image. This is much faster
+            when the objects cover a small part of a large image. Where
+            objects overlap, the pixel may take the color of either
+            object.</li>
+            </ul>""" % globals()))
+
+        group.append("wants_bin_statistics", cps.Binary(
+            "Accumulate per-bin statistics across the experiment?", False,
+            doc="""
+            Select <i>%(YES)s</i> to record the sum and the sum of squares
+            of the measurement over the objects in each bin as the image
+            measurements <i>%(F_SUM_PER_BIN)s</i> and
+            <i>%(F_SUM_OF_SQUARES_PER_BIN)s</i>. After the last image set,
+            the module combines them into these experiment measurements for
+            each bin:
+            <ul>
+            <li><i>%(F_TOTAL_PER_BIN)s:</i> The number of objects in the bin
+            over all image sets.</li>
+            <li><i>%(F_MEAN_PER_BIN)s, %(F_STDEV_PER_BIN)s:</i> The mean
+            and standard deviation of the measurement over those
+            objects.</li>
+            </ul>
+            The statistics take a few image measurements per bin and don't
+            require a second pass over the object measurements. The image
+            sets are still processed in parallel. In batch mode, each job
+            records the statistics of its own image sets.""" % globals()))
+
+        group.append("object_output", cps.Choice(
+            "Per-object classification output", [OO_ONE_HOT, OO_BIN_NUMBER],
+            doc="""
+            Choose how each object's classification is recorded.
+            <ul>
+            <li><i>%(OO_ONE_HOT)s:</i> One measurement per bin, which is 1
+            for objects in the bin and 0 otherwise.</li>
+            <li><i>%(OO_BIN_NUMBER)s:</i> A single measurement,
+            <i>%(M_CATEGORY)s_&lt;measurement&gt;_%(F_BIN_NUMBER)s</i>,
+            holding the number of each object's bin, or 0 for objects that
+            are not in any bin. This is much smaller when there are many
+            bins.</li>
+            </ul>""" % globals()))
+
+        group.append("wants_joint_classification", cps.Binary(
+            "Classify jointly with the previous classification?", False,
+            doc="""
+            Select <i>%(YES)s</i> to also classify the objects by their
+            combination of bins in this classification and the one above
+            it, for example to count the large, bright objects when
+            classifying by size and by intensity. The classifications must
+            be of the same objects and can't use
+            <i>%(BC_QUANTILE)s</i>. Up to %(MAX_JOINT_MEASUREMENTS)d
+            classifications can be combined by answering <i>%(YES)s</i>
+            for each one after the first.
+            <p>The joint classification records the number and percentage
+            of objects in each joint bin, named by joining the names of the
+            bins, and the number of each object's joint bin in
+            <i>%(M_CATEGORY)s_&lt;measurements&gt;_%(F_JOINT_BIN)s</i>, or 0
+            for objects outside of a bin in any of the classifications.
+            This is much faster and smaller than combining the
+            classifications later in the pipeline.</p>""" % globals()))
+
+        group.append("wants_parent_thresholds", cps.Binary(
+            "Use measurements of each object's parent as thresholds?", False,
+            doc="""
+            <i>(Used only if Evenly spaced bins selected)</i><br>
+            Select <i>%(YES)s</i> to give each object its own low and high
+            thresholds, taken from measurements of its parent object. For
+            example, speckles can be classified by their position within
+            the bounding box of the cell that holds them. The objects must
+            have been related to their parents by a previous module, such
+            as <b>RelateObjects</b>. Objects without a parent are not put
+            in any bin.""" % globals()))
+
+        group.append("parent_name", cps.ObjectNameSubscriber(
+            "Select the parent objects", cps.NONE, doc="""
+            Select the parent objects whose measurements give the
+            thresholds."""))
+
+        group.append("low_parent_measurement", cps.Measurement(
+            "Parent measurement to use for low threshold",
+            group.get_parent_name, doc="""
+            Choose the measurement of the parent objects to use as each
+            object's low threshold."""))
+
+        group.append("high_parent_measurement", cps.Measurement(
+            "Parent measurement to use for high threshold",
+            group.get_parent_name, doc="""
+            Choose the measurement of the parent objects to use as each
+            object's high threshold."""))
+
+        group.append("wants_no_bin_reasons", cps.Binary(
+            "Record why objects are outside of every bin?", False, doc="""
+            The module counts the objects of each image that are outside of
+            every bin because their value is at or below the lowest
+            threshold (<i>%(F_NUM_BELOW_RANGE)s</i>), above the highest
+            threshold (<i>%(F_NUM_ABOVE_RANGE)s</i>) or missing
+            (<i>%(F_NUM_NAN)s</i>, which also counts objects whose
+            thresholds are missing). These objects still count toward the
+            percentages of the bins.
+            <p>Select <i>%(YES)s</i> to also record the reason for each
+            object in
+            <i>%(M_CATEGORY)s_&lt;measurement&gt;_%(F_NO_BIN_REASON)s</i>:
+            %(NB_BELOW)d, %(NB_ABOVE)d or %(NB_NAN)d for these reasons in
+            the same order, or 0 for objects in a bin.</p>""" % globals()))
 
         if can_delete:
             group.remove_settings_button = cps.RemoveSettingButton(
@@ -328,9 +1840,13 @@ class ClassifyObjects(cpm.CPModule):
 
     def settings(self):
         result = [self.single_measurement_count]
-        result += reduce(lambda x, y: x+y,
-                         [group.pipeline_settings()
-                          for group in self.single_measurements])
+        for group in self.single_measurements:
+            result += group.pipeline_settings()
+        result += [self.wants_stage_timing, self.display_mode,
+                   self.thread_count, self.wants_tiled_rendering,
+                   self.tile_rows, self.wants_memmap_images,
+                   self.wants_result_cache, self.cache_directory,
+                   self.cache_size, self.wants_cached_images]
         return result
 
     def visible_settings(self):
@@ -341,23 +1857,33 @@ class ClassifyObjects(cpm.CPModule):
                 result += [group.divider]
             result += [group.object_name, group.measurement,
                        group.bin_choice]
-            if group.bin_choice == BC_EVEN:
-                result += [group.bin_count, group.top_threshold_divider]
+            if group.bin_choice == BC_EVEN and group.wants_parent_thresholds:
+                result += [group.bin_count, group.top_threshold_divider,
+                           group.wants_parent_thresholds, group.parent_name,
+                           group.low_parent_measurement, group.wants_low_bin,
+                           group.high_parent_measurement,
+                           group.wants_high_bin]
+            elif group.bin_choice == BC_EVEN:
+                result += [group.bin_count, group.top_threshold_divider,
+                           group.wants_parent_thresholds]
                 for dynamic_threshold, measurement, \
-                    static_threshold, extra_bin in (
+                    static_threshold, extra_bin, dividers in (
                         (group.wants_image_based_low_threshold,
                             group.low_threshold_measurement,
-                            group.low_threshold, group.wants_low_bin),
+                            group.low_threshold, group.wants_low_bin,
+                            [group.middle_threshold_divider]),
                         (group.wants_image_based_high_threshold,
                             group.high_threshold_measurement,
-                            group.high_threshold, group.wants_high_bin)):
+                            group.high_threshold, group.wants_high_bin,
+                            [])):
                     result += [dynamic_threshold]
                     if not dynamic_threshold:
                         result += [static_threshold, extra_bin]
                     else:
                         result += [measurement]
-                    if group.middle_threshold_divider not in result:
-                        result += [group.middle_threshold_divider]
+                    result += dividers
+            elif group.bin_choice == BC_QUANTILE:
+                result += [group.bin_count]
             else:
                 result += [group.custom_thresholds,
                            group.wants_low_bin, group.wants_high_bin]
@@ -365,129 +1891,689 @@ class ClassifyObjects(cpm.CPModule):
             result += [group.wants_custom_names]
             if group.wants_custom_names:
                 result += [group.bin_names]
-            result += [group.wants_images]
-            if group.wants_images:
-                result += [group.image_name]
+            result += [group.object_output, group.wants_no_bin_reasons]
+            if group.can_delete and group.bin_choice != BC_QUANTILE:
+                result += [group.wants_joint_classification]
+            if group.bin_choice != BC_QUANTILE:
+                result += [group.wants_bin_statistics, group.wants_images]
+            if group.wants_images and group.bin_choice != BC_QUANTILE:
+                result += [group.image_name, group.image_type]
+                if group.image_type == IT_COLOR:
+                    result += [group.image_precision]
+                result += [group.render_method]
             if group.can_delete:
                 result += [group.remove_settings_button]
-        result += [self.add_measurement_button]
+        result += [self.add_measurement_button, self.stage_timing_divider,
+                   self.wants_stage_timing, self.display_mode,
+                   self.thread_count, self.wants_tiled_rendering]
+        if self.wants_tiled_rendering:
+            result += [self.tile_rows]
+        result += [self.wants_memmap_images, self.wants_result_cache]
+        if self.wants_result_cache:
+            result += [self.cache_directory, self.cache_size,
+                       self.wants_cached_images]
         return result
 
+    def wants_display_data(self):
+        '''True if run should collect the data for the display window'''
+        return self.show_window and self.display_mode != DM_NONE
+
     def run(self, workspace):
         """Classify the objects in the image cycle"""
-        if self.show_window:
-            workspace.display_data.labels = []
-            workspace.display_data.bins = []
-            workspace.display_data.values = []
-        for group in self.single_measurements:
-            self.run_single_measurement(group, workspace)
+        if self.wants_display_data():
+            group_count = len(self.single_measurements)
+            workspace.display_data.labels = [None] * group_count
+            workspace.display_data.bin_counts = [None] * group_count
+            workspace.display_data.value_counts = [None] * group_count
+            workspace.display_data.value_edges = [None] * group_count
+            workspace.display_data.colors = [None] * group_count
+        #
+        # Classify all groups that share objects in a single pass so that
+        # the objects and their label matrix are only visited once.
+        #
+        for object_name, plans in self.get_object_groups():
+            self.run_object_measurements(object_name, plans, workspace)
 
     def display(self, workspace, figure):
+        if self.display_mode == DM_NONE:
+            figure.set_subplots((1, 1))
+            figure.subplot_table(
+                0, 0, [["No data is kept for the display window. Choose "
+                        "%s or %s to display the classification." %
+                        (DM_THUMBNAIL, DM_FULL)]])
+            return
         self.display_single_measurement(workspace, figure)
 
-    def run_single_measurement(self, group, workspace):
-        '''Classify objects based on one measurement'''
-        object_name = group.object_name.value
-        feature = group.measurement.value
-        objects = workspace.object_set.get_objects(object_name)
-        measurements = workspace.measurements
-        values = measurements.get_current_measurement(object_name, feature)
-        if group.bin_choice == BC_EVEN:
+    def invalidate_bin_plans(self):
+        '''Discard the compiled bin plans after the settings change'''
+        self.bin_plans = None
 
-            if group.wants_image_based_low_threshold:
-                low_threshold = measurements.get_current_image_measurement(
-                    group.low_threshold_measurement.value)
-            else:
-                low_threshold = group.low_threshold.value
+    def get_measurement_names(self):
+        '''Return the measurement_name() of each of the single measurements
 
-            if group.wants_image_based_high_threshold:
-                high_threshold = measurements.get_current_image_measurement(
-                    group.high_threshold_measurement.value)
+        Same naming as the groups' measurement_name(), but counting the
+        earlier groups as we go rather than rescanning them.
+        '''
+        result = []
+        measurement_counts = {}
+        for group in self.single_measurements:
+            measurement_name = group.measurement.value
+            other_same = measurement_counts.get(measurement_name, 0)
+            measurement_counts[measurement_name] = other_same + 1
+            if other_same > 0:
+                measurement_name += str(other_same)
+            result.append(measurement_name)
+        return result
+
+    def compile_bin_plans(self):
+        '''Compile a BinPlan for each of the single measurements'''
+        plans = [BinPlan(group, measurement_name)
+                 for group, measurement_name in zip(
+                     self.single_measurements, self.get_measurement_names())]
+        for chain in self.get_joint_classifications():
+            chain_plans = [plans[index] for index in chain]
+            if (len(chain) > MAX_JOINT_MEASUREMENTS or
+                any([plan.is_quantile or
+                     plan.object_name != chain_plans[0].object_name
+                     for plan in chain_plans])):
+                continue
+            chain_plans[-1].joint_plan = JointPlan(chain, chain_plans)
+        return plans
+
+    def get_joint_classifications(self):
+        '''Find the classifications combined in joint classifications
+
+        Returns a list with the indexes in self.single_measurements of the
+        classifications of each joint classification.
+        '''
+        result = []
+        for index, group in enumerate(self.single_measurements):
+            if index == 0 or not group.wants_joint():
+                continue
+            if len(result) > 0 and result[-1][-1] == index - 1:
+                result[-1].append(index)
             else:
-                high_threshold = group.high_threshold.value
+                result.append([index - 1, index])
+        return result
+
+    def get_joint_features(self, chain, measurement_names=None):
+        '''Return the measurement name and the bin feature names of a joint
+        classification
 
-            bin_count = group.bin_count.value
-            thresholds = (np.arange(bin_count+1) *
-                          (high_threshold - low_threshold)/float(bin_count) +
-                          low_threshold)
+        chain - the indexes of the joint classification's classifications
+        measurement_names - get_measurement_names() if already known
+        '''
+        if measurement_names is None:
+            measurement_names = self.get_measurement_names()
+        groups = [self.single_measurements[index] for index in chain]
+        names = [measurement_names[index] for index in chain]
+        measurement_name = '_'.join(names)
+        feature_names = [
+            '_'.join(bin_names) for bin_names in itertools.product(
+                *[group.bin_feature_names(name)
+                  for group, name in zip(groups, names)])]
+        return measurement_name, feature_names
+
+    def get_bin_plans(self):
+        '''Return the bin plans, compiling them if the settings changed'''
+        if self.bin_plans is None:
+            self.bin_plans = self.compile_bin_plans()
+        return self.bin_plans
+
+    def get_object_groups(self):
+        '''Collect the classifications that classify the same objects
+
+        Returns a list of (object name, plans) in pipeline order. plans is
+        a list of (index, plan) where index is the classification's
+        position in self.single_measurements.
+        '''
+        result = []
+        plans_by_name = {}
+        for index, plan in enumerate(self.get_bin_plans()):
+            if plan.object_name not in plans_by_name:
+                plans_by_name[plan.object_name] = []
+                result.append((plan.object_name,
+                               plans_by_name[plan.object_name]))
+            plans_by_name[plan.object_name].append((index, plan))
+        return result
+
+    def run_object_measurements(self, object_name, plans, workspace):
+        '''Classify one set of objects by one or more measurements
+
+        object_name - the name of the objects to classify
+        plans - a list of (index, plan) giving the BinPlan of each
+                classification of these objects and its position in
+                self.single_measurements
+        '''
+        measurements = workspace.measurements
+        if self.wants_stage_timing:
+            timer = StageTimer()
         else:
-            thresholds = [float(x.strip())
-                          for x in group.custom_thresholds.value.split(', ')]
+            timer = NULL_STAGE_TIMER
+        try:
+            self.classify_objects(object_name, plans, workspace, timer)
+        finally:
+            timer.add_measurements(measurements, object_name)
+
+    def classify_objects(self, object_name, plans, workspace, timer):
+        '''Classify, record and render one set of objects
+
+        See run_object_measurements. timer - the StageTimer that times
+        each step
+        '''
+        measurements = workspace.measurements
         #
-        # Put infinities at either end of the thresholds so we can bin the
-        # low and high bins
+        # Equal-frequency bins are classified in post_group. Until then,
+        # only keep each object's value in single precision.
         #
-        thresholds = np.hstack(([-np.inf] if group.wants_low_bin else [],
-                                thresholds,
-                                [np.inf] if group.wants_high_bin else []))
-        #
-        # Do a cross-product of objects and threshold comparisons
-        #
-        ob_idx, th_idx = np.mgrid[0:len(values), 0:len(thresholds)-1]
-        bin_hits = ((values[ob_idx] > thresholds[th_idx]) &
-                    (values[ob_idx] <= thresholds[th_idx+1]))
-        num_values = len(values)
-        for bin_idx, feature_name in enumerate(group.bin_feature_names()):
-            measurement_name = '_'.join((M_CATEGORY, feature_name))
-            measurements.add_measurement(object_name, measurement_name,
-                                         bin_hits[:, bin_idx].astype(int))
-            measurement_name = '_'.join(
-                (M_CATEGORY, feature_name, F_NUM_PER_BIN))
-            num_hits = bin_hits[:, bin_idx].sum()
-            measurements.add_measurement(cpmeas.IMAGE, measurement_name,
-                                         num_hits)
-            measurement_name = '_'.join(
-                (M_CATEGORY, feature_name, F_PCT_PER_BIN))
-            measurements.add_measurement(
-                cpmeas.IMAGE, measurement_name,
-                100.0*float(num_hits)/num_values if num_values > 0 else 0)
-        if group.wants_images or (self.show_window):
-            colors = self.get_colors(bin_hits.shape[1])
-            object_bins = np.sum(bin_hits * th_idx, 1)+1
-            object_color = np.hstack(([0], object_bins))
-            object_color[np.hstack((False, np.isnan(values)))] = 0
-            labels = object_color[objects.segmented]
-            if group.wants_images:
-                image = colors[labels, :3]
-                workspace.image_set.add(
-                    group.image_name.value,
-                    cpi.Image(image, parent_image=objects.parent_image))
-
-            if self.show_window:
-                workspace.display_data.bins.append(object_bins[~np.isnan(values)])
-                workspace.display_data.labels.append(labels)
-                workspace.display_data.values.append(values[~np.isnan(values)])
+        timer.begin(S_FETCH)
+        for index, plan in plans:
+            if plan.is_quantile:
+                self.buffer_quantile_measurement(index, plan, measurements)
+        plans = [(index, plan) for index, plan in plans
+                 if not plan.is_quantile]
+        if len(plans) == 0:
+            timer.end()
+            return
+        objects = workspace.object_set.get_objects(object_name)
+        values = [measurements.get_current_measurement(
+            object_name, plan.feature) for _, plan in plans]
+        timer.end(*values)
+        timer.begin(S_THRESHOLDS)
+        thresholds = [plan.get_thresholds(measurements) for _, plan in plans]
+        timer.end(*thresholds)
+        cache = self.get_result_cache()
+        cached = None
+        if cache is not None:
+            timer.begin(S_CACHE)
+            key = get_result_key(plans, values, thresholds)
+            entry = cache.get(key)
+            if entry is not None:
+                bin_counts = [plan_thresholds.shape[-1] - 1
+                              for plan_thresholds in thresholds]
+                cached = (entry["bin_indexes"].astype(int), np.split(
+                    entry["counts"], np.cumsum(bin_counts)[:-1]),
+                    entry["reason_counts"])
+            timer.end()
+        bin_indexes, bin_hit_counts, reason_counts = self.classify_values(
+            plans, values, thresholds, measurements, timer, cached=cached)
+        if cache is not None and cached is None:
+            timer.begin(S_CACHE)
+            index_dtype = bin_index_dtype(
+                max([plan.bin_count for _, plan in plans]))
+            cache.put(key, dict(bin_indexes=bin_indexes.astype(index_dtype),
+                                counts=np.hstack(bin_hit_counts),
+                                reason_counts=reason_counts))
+            timer.end()
+
+        wants_display_data = self.wants_display_data()
+        rendered = [k for k, (_, plan) in enumerate(plans)
+                    if plan.wants_images or wants_display_data]
+        if len(rendered) == 0:
+            return
+        #
+        # Reuse the images if the objects and their classification are
+        # unchanged, unless they are needed for the display anyway
+        #
+        image_key = None
+        if (cache is not None and self.wants_cached_images and
+                not wants_display_data):
+            timer.begin(S_CACHE)
+            digest = hashlib.sha1(key.encode("utf-8"))
+            digest.update(cpprefs.get_default_colormap().encode("utf-8"))
+            digest.update(str(objects.segmented.shape).encode("utf-8"))
+            digest.update(np.ascontiguousarray(objects.segmented))
+            image_key = digest.hexdigest()
+            entry = cache.get(image_key)
+            timer.end()
+            #
+            # The images are named by their position among the plans of
+            # these objects, which the key covers, and not by their
+            # position in the module, which it doesn't.
+            #
+            names = ["image%d" % k for k, (_, plan) in enumerate(plans)
+                     if plan.wants_images]
+            if entry is not None and all([name in entry for name in names]):
+                for k, (_, plan) in enumerate(plans):
+                    if plan.wants_images:
+                        self.add_image(workspace, plan,
+                                       entry["image%d" % k], objects)
+                return
+        timer.begin(S_RENDER)
+        #
+        # Build a table of the color index of each object in each rendered
+        # classification so that a single pass over the label matrix colors
+        # them all. Objects outside of every bin are drawn with the first
+        # bin's color; only objects without a measurement are left blank.
+        #
+        object_bins = np.maximum(bin_indexes[rendered], 0) + 1
+        label_dtype = smallest_unsigned_dtype(
+            max([plans[k][1].bin_count for k in rendered]))
+        object_color = np.zeros((len(object_bins[0]) + 1, len(rendered)),
+                                label_dtype)
+        object_color[1:] = object_bins.transpose()
+        object_color[1:][np.isnan(np.vstack(
+            [values[k] for k in rendered])).transpose()] = 0
+        dense = [column for column, k in enumerate(rendered)
+                 if plans[k][1].render_method == RM_ALL]
+        sparse = [column for column, k in enumerate(rendered)
+                  if plans[k][1].render_method != RM_ALL]
+        if len(sparse) > 0:
+            ijv = objects.ijv
+        if wants_display_data:
+            #
+            # The display gets every step'th pixel of the labels
+            #
+            if self.display_mode == DM_THUMBNAIL:
+                step = get_thumbnail_step(objects.shape)
+            else:
+                step = 1
+            display_shape = tuple([(side + step - 1) // step
+                                   for side in objects.shape])
+            if len(sparse) > 0 and step > 1:
+                on_display = ((ijv[:, 0] % step) == 0) & \
+                    ((ijv[:, 1] % step) == 0)
+                display_ijv = ijv[on_display, :2] // step
+        #
+        # Allocate the classified images, with the color lookup table of
+        # each color image, and the labels for the display
+        #
+        images = [None] * len(rendered)
+        luts = [None] * len(rendered)
+        display_labels = [None] * len(rendered)
+        for column, k in enumerate(rendered):
+            plan = plans[k][1]
+            if plan.wants_images:
+                if plan.image_type == IT_BIN_LABELS:
+                    images[column] = self.allocate_image(
+                        objects.shape, label_dtype)
+                else:
+                    if plan.colors is None:
+                        plan.colors = self.get_colors(plan.bin_count)
+                    luts[column] = plan.get_image_lut(plan.colors)
+                    images[column] = self.allocate_image(
+                        tuple(objects.shape) + luts[column].shape[1:],
+                        luts[column].dtype)
+            if wants_display_data:
+                display_labels[column] = np.zeros(display_shape, label_dtype)
+        #
+        # Classifications that render every pixel share one pass over each
+        # tile of rows of the label matrix.
+        #
+        if len(dense) > 0:
+            pool = self.get_thread_pool()
+            row_count = objects.segmented.shape[0]
+            if self.wants_tiled_rendering:
+                tile_rows = min(self.tile_rows.value, row_count)
+            else:
+                tile_rows = row_count
+            tile_labels = self.get_label_buffer(
+                (tile_rows,) + objects.segmented.shape[1:] + (len(dense),),
+                label_dtype)
+            for start in range(0, row_count, tile_rows):
+                stop = min(start + tile_rows, row_count)
+                all_labels = take_rows(
+                    object_color[:, dense], objects.segmented[start:stop],
+                    tile_labels[:stop - start], pool,
+                    self.thread_count.value)
+                for tile_column, column in enumerate(dense):
+                    labels = all_labels[..., tile_column]
+                    if luts[column] is not None:
+                        take_rows(luts[column], labels,
+                                  images[column][start:stop], pool,
+                                  self.thread_count.value)
+                    elif images[column] is not None:
+                        images[column][start:stop] = labels
+                    if display_labels[column] is not None:
+                        first = (-start) % step
+                        display_labels[column][
+                            (start + first) // step:
+                            (stop + step - 1) // step] = \
+                            labels[first::step, ::step]
+        #
+        # The others only visit the objects' pixels.
+        #
+        for column in sparse:
+            pixel_labels = object_color[ijv[:, 2], column]
+            if luts[column] is not None:
+                scatter_pixels(objects.shape, ijv, luts[column][pixel_labels],
+                               out=images[column])
+            elif images[column] is not None:
+                scatter_pixels(objects.shape, ijv, pixel_labels,
+                               out=images[column])
+            if display_labels[column] is not None:
+                if step > 1:
+                    scatter_pixels(display_shape, display_ijv,
+                                   pixel_labels[on_display],
+                                   out=display_labels[column])
+                else:
+                    scatter_pixels(display_shape, ijv, pixel_labels,
+                                   out=display_labels[column])
+        timer.end(*images)
+
+        if image_key is not None:
+            timer.begin(S_CACHE)
+            cache.put(image_key, dict([
+                ("image%d" % k, images[column])
+                for column, k in enumerate(rendered)
+                if plans[k][1].wants_images]))
+            timer.end()
+
+        for column, k in enumerate(rendered):
+            index, plan = plans[k]
+            if plan.wants_images:
+                self.add_image(workspace, plan, images[column], objects)
+
+            if wants_display_data:
+                timer.begin(S_DISPLAY)
+                #
+                # Send histograms rather than the objects' values so that
+                # the display data doesn't grow with the number of objects
+                #
+                plan_values = values[k]
+                has_value = ~np.isnan(plan_values)
+                bin_counts = np.bincount(object_bins[column][has_value],
+                                         minlength=plan.bin_count + 1)[1:]
+                finite_values = plan_values[np.isfinite(plan_values)]
+                value_counts, value_edges = np.histogram(
+                    finite_values, bins=DISPLAY_HISTOGRAM_BINS)
+                if plan.colors is None:
+                    plan.colors = self.get_colors(plan.bin_count)
+                workspace.display_data.labels[index] = display_labels[column]
+                workspace.display_data.bin_counts[index] = bin_counts
+                workspace.display_data.value_counts[index] = value_counts
+                workspace.display_data.value_edges[index] = value_edges
+                workspace.display_data.colors[index] = plan.colors
+                timer.end(display_labels[column], bin_counts, value_counts,
+                          value_edges)
+
+    def add_image(self, workspace, plan, image, objects):
+        '''Add a classification's image to the image set'''
+        workspace.image_set.add(
+            plan.image_name,
+            cpi.Image(image, parent_image=objects.parent_image,
+                      convert=(plan.image_type == IT_COLOR and
+                               plan.image_precision != IP_UINT8)))
+
+    def classify_values(self, plans, values, thresholds, measurements,
+                        timer=NULL_STAGE_TIMER, image_set_number=None,
+                        cached=None):
+        '''Bin the objects of one image set and record their classification
+
+        plans - a list of (index, plan) of classifications of the same
+                objects, none of which has equal-frequency bins
+        values - the measurement values of each classification
+        thresholds - the bin edges of each classification
+        measurements - the measurements to write to
+        timer - the StageTimer that times each step
+        image_set_number - the image set to write to or None for the
+                           current one
+        cached - the bin indexes, the number of objects in each bin and
+                 the number in no bin for each reason of each
+                 classification from the result cache or None to compute
+                 them
+
+        Returns the bin indexes, one row per classification, the number of
+        objects in each bin of each classification and an array with a row
+        of the number of objects with each reason for no bin of each
+        classification.
+        '''
+        bin_counts = [plan_thresholds.shape[-1] - 1
+                      for plan_thresholds in thresholds]
+        #
+        # One row of bin indices per classification, counted all at once
+        #
+        timer.begin(S_BINNING)
+        if cached is None:
+            bin_indexes = np.vstack([
+                bin_values(plan_values, plan_thresholds)
+                for plan_values, plan_thresholds in zip(values, thresholds)])
+            bin_hit_counts, reason_counts = count_bins_and_reasons(
+                bin_indexes, bin_counts)
+        else:
+            bin_indexes, bin_hit_counts, reason_counts = cached
+        #
+        # Combine the bin indexes of joint classifications
+        #
+        rows = dict([(index, k) for k, (index, _) in enumerate(plans)])
+        joint_bins = []
+        for _, plan in plans:
+            joint_plan = plan.joint_plan
+            if joint_plan is None:
+                continue
+            joint_index = joint_plan.get_bin_index(
+                [bin_indexes[rows[index]] for index in joint_plan.indexes])
+            joint_bins.append((joint_plan, joint_index) +
+                              count_bins_and_reasons(
+                                  joint_index, joint_plan.bin_count))
+        timer.end(bin_indexes, *bin_hit_counts)
+        timer.begin(S_STATISTICS)
+        sums = [(plan,) + BinStatistics.get_sums(
+                    plan_values, bin_index, plan.bin_count)
+                for (_, plan), bin_index, plan_values in zip(
+                    plans, bin_indexes, values)
+                if plan.wants_statistics]
+        timer.end(*[array for row in sums for array in row[1:]])
+        timer.begin(S_WRITE)
+        batch = MeasurementBatch(measurements, image_set_number)
+        for plan, plan_sums, plan_sums_of_squares in sums:
+            batch.add_image_measurements(plan.sum_features, plan_sums)
+            batch.add_image_measurements(plan.sum_of_squares_features,
+                                         plan_sums_of_squares)
+        nbytes = 0
+        for (_, plan), bin_index, num_hits_per_bin, num_no_bin in zip(
+                plans, bin_indexes, bin_hit_counts, reason_counts):
+            nbytes += self.add_bin_measurements(
+                batch, plan, bin_index, num_hits_per_bin, num_no_bin)
+        for joint_plan, joint_index, num_hits_per_bin, num_no_bin in \
+                joint_bins:
+            nbytes += self.add_bin_measurements(
+                batch, joint_plan, joint_index, num_hits_per_bin,
+                num_no_bin)
+        batch.flush()
+        timer.end(nbytes)
+        return bin_indexes, bin_hit_counts, reason_counts
+
+    def add_bin_measurements(self, batch, plan, bin_index,
+                             num_hits_per_bin, num_no_bin):
+        '''Record the classification of one image set's objects
+
+        batch - the MeasurementBatch of the image set
+        plan - the classification's BinPlan
+        bin_index - the bin index of each object
+        num_hits_per_bin - the number of objects in each bin
+        num_no_bin - the number of objects with each code in
+                     NO_BIN_REASONS
+
+        Returns the number of bytes of per-object measurements written.
+        '''
+        bin_count = len(plan.feature_names)
+        num_values = len(bin_index)
+        if plan.wants_bin_numbers:
+            bin_numbers = np.maximum(bin_index + 1, 0).astype(
+                plan.bin_number_dtype)
+            nbytes = batch.add_object_measurements(
+                plan.object_name, [plan.bin_number_feature],
+                bin_numbers[np.newaxis, :])
+        else:
+            #
+            # One row of 0/1 flags per bin, made as each is written
+            #
+            nbytes = batch.add_bin_flags(
+                plan.object_name, plan.object_features, bin_index)
+        if plan.wants_no_bin_reasons:
+            reasons = np.minimum(bin_index, 0).astype(np.int8)
+            nbytes += batch.add_object_measurements(
+                plan.object_name, [plan.no_bin_reason_feature],
+                reasons[np.newaxis, :])
+        num_hits_per_bin = np.asarray(num_hits_per_bin)[:bin_count]
+        if num_values > 0:
+            percents = 100.0 * num_hits_per_bin / float(num_values)
+        else:
+            percents = np.zeros(bin_count)
+        batch.add_image_measurements(plan.count_features, num_hits_per_bin)
+        batch.add_image_measurements(plan.percent_features, percents)
+        batch.add_image_measurements(plan.no_bin_features, num_no_bin)
+        return nbytes
+
+    def buffer_quantile_measurement(self, index, plan, measurements):
+        '''Keep the objects of a classification with equal-frequency bins
+        until the end of the group'''
+        self.add_quantile_values(
+            index, measurements.get_current_measurement(
+                plan.object_name, plan.feature),
+            measurements.image_set_number)
+
+    def add_quantile_values(self, index, values, image_set_number):
+        '''Keep the values of one image set's objects
+
+        index - the index of the classification with equal-frequency bins
+        values - the measurement values of the objects
+        image_set_number - the image set of the objects
+        '''
+        if index not in self.quantile_buffers:
+            self.quantile_buffers[index] = []
+        self.quantile_buffers[index].append(
+            (image_set_number, np.asarray(values, np.float32)))
+
+    def is_aggregation_module(self):
+        '''Equal-frequency bins need every image set of a group'''
+        return any([group.bin_choice == BC_QUANTILE
+                    for group in self.single_measurements])
+
+    def prepare_group(self, workspace, grouping, image_numbers):
+        '''Start keeping the objects of a new group'''
+        self.quantile_buffers = {}
+
+    def post_group(self, workspace, grouping):
+        '''Classify the objects of the group into equal-frequency bins
+
+        This runs in the process that ran every image set of the group,
+        unlike post_run, which runs in the process that started the
+        analysis. The rendering threads of that process are stopped here.
+        '''
+        self.classify_quantile_buffers(workspace.measurements)
+        self.close_thread_pool()
+
+    def post_run(self, workspace):
+        '''Record the per-bin statistics of every image set and stop the
+        rendering threads if the images were classified in this process'''
+        self.add_experiment_statistics(workspace.measurements)
+        self.close_thread_pool()
+
+    def classify_quantile_buffers(self, measurements):
+        '''Classify the kept objects into equal-frequency bins'''
+        plans = self.get_bin_plans()
+        for index, image_sets in self.quantile_buffers.items():
+            if index >= len(plans) or not plans[index].is_quantile:
+                continue
+            plan = plans[index]
+            cuts = get_quantile_cuts(
+                np.hstack([np.zeros(0, np.float32)] +
+                          [values for _, values in image_sets]),
+                plan.bin_count)
+            for image_set_number, values in image_sets:
+                bin_index = bin_quantile_values(values, cuts)
+                batch = MeasurementBatch(measurements, image_set_number)
+                self.add_bin_measurements(
+                    batch, plan, bin_index,
+                    *count_bins_and_reasons(bin_index, plan.bin_count))
+                batch.flush()
+        self.quantile_buffers = {}
+
+    def get_result_cache(self):
+        '''Return the ResultCache or None if results aren't reused'''
+        if not self.wants_result_cache:
+            return None
+        directory = self.cache_directory.value.strip()
+        if len(directory) == 0:
+            directory = os.path.join(cpprefs.get_temporary_directory(),
+                                     RESULT_CACHE_FOLDER)
+        max_bytes = self.cache_size.value * 1024 * 1024
+        if (self.result_cache is None or
+                self.result_cache.directory != directory):
+            self.result_cache = ResultCache(directory, max_bytes)
+        self.result_cache.max_bytes = max_bytes
+        return self.result_cache
+
+    def get_thread_pool(self):
+        '''Return the pool of threads for rendering or None for one thread
+
+        The pool is kept from cycle to cycle until the end of the group and
+        replaced if the number of threads changes.
+        '''
+        thread_count = self.thread_count.value
+        if thread_count <= 1:
+            return None
+        if self.thread_pool is None or self.thread_pool_size != thread_count:
+            self.close_thread_pool()
+            self.thread_pool = multiprocessing.pool.ThreadPool(thread_count)
+            self.thread_pool_size = thread_count
+        return self.thread_pool
+
+    def close_thread_pool(self):
+        '''Stop the threads of the pool, if there is one'''
+        if self.thread_pool is not None:
+            self.thread_pool.close()
+            self.thread_pool.join()
+            self.thread_pool = None
+            self.thread_pool_size = 0
+
+    def allocate_image(self, shape, dtype):
+        '''Return a zeroed array for a classified image
+
+        The array is mapped to a temporary file if the user chose to store
+        images in temporary files. The file is deleted when the array is.
+        '''
+        if not self.wants_memmap_images:
+            return np.zeros(shape, dtype)
+        fd = tempfile.TemporaryFile(
+            prefix="ClassifyObjects", dir=cpprefs.get_temporary_directory())
+        return np.memmap(fd, dtype, mode="w+", shape=shape)
+
+    def get_label_buffer(self, shape, dtype):
+        '''Return scratch space for the labels of rendered classifications
+
+        The buffer is kept from cycle to cycle and only reallocated when the
+        image size, number of rendered classifications or type changes.
+        '''
+        if (self.label_buffer is None or self.label_buffer.shape != shape or
+                self.label_buffer.dtype != dtype):
+            self.label_buffer = np.zeros(shape, dtype)
+        return self.label_buffer
 
     def display_single_measurement(self, workspace, figure):
         '''Display an array of single measurements'''
         figure.set_subplots((3, len(self.single_measurements)))
         for i, group in enumerate(self.single_measurements):
-            bin_hits = workspace.display_data.bins[i]
+            bin_counts = workspace.display_data.bin_counts[i]
             labels = workspace.display_data.labels[i]
-            values = workspace.display_data.values[i]
-            if len(values) == 0:
+            value_counts = workspace.display_data.value_counts[i]
+            value_edges = workspace.display_data.value_edges[i]
+            colors = workspace.display_data.colors[i]
+            if bin_counts is None or bin_counts.sum() == 0:
                 continue
             #
             # A histogram of the values
             #
             axes = figure.subplot(0, i)
-            axes.hist(values[~np.isnan(values)])
+            axes.bar(value_edges[:-1], value_counts,
+                     width=np.diff(value_edges), align='edge')
             axes.set_xlabel(group.measurement.value)
             axes.set_ylabel("# of %s" % group.object_name.value)
             #
             # A histogram of the labels yielding the bins
             #
             axes = figure.subplot(1, i)
-            axes.hist(bin_hits, bins=group.number_of_bins(),
-                      range=(.5, group.number_of_bins()+.5))
-            axes.set_xticks(np.arange(1, group.number_of_bins()+1))
+            bin_count = len(bin_counts)
+            axes.bar(np.arange(1, bin_count+1), bin_counts, width=1,
+                     align='center', color=colors[1:bin_count+1])
+            axes.set_xlim(.5, bin_count+.5)
+            axes.set_xticks(np.arange(1, bin_count+1))
             if group.wants_custom_names:
                 axes.set_xticklabels(group.bin_names.value.split(","))
             axes.set_xlabel(group.measurement.value)
             axes.set_ylabel("# of %s" % group.object_name.value)
-            colors = self.get_colors(len(axes.patches))
-            for j, patch in enumerate(axes.patches):
-                patch.set_facecolor(colors[j+1, :])
             #
             # The labels matrix
             #
@@ -498,14 +2584,7 @@ class ClassifyObjects(cpm.CPModule):
 
     def get_colors(self, count):
         '''Get colors used for two-measurement labels image'''
-        import matplotlib.cm as cm
-        cmap = cm.get_cmap(cpprefs.get_default_colormap())
-        #
-        # Trick the colormap into divulging the values used.
-        #
-        sm = cm.ScalarMappable(cmap=cmap)
-        colors = sm.to_rgba(np.arange(count)+1)
-        return np.vstack((np.zeros(colors.shape[1]), colors))
+        return get_colormap_lut(cpprefs.get_default_colormap(), count)
 
     def prepare_settings(self, setting_values):
         """Do any sort of adjustment to the settings required for the
@@ -525,10 +2604,99 @@ class ClassifyObjects(cpm.CPModule):
             del self.single_measurements[single_measurement_count:]
         while single_measurement_count > len(self.single_measurements):
             self.add_single_measurement(True)
+        self.invalidate_bin_plans()
+
+    def on_setting_changed(self, setting, pipeline):
+        self.invalidate_bin_plans()
 
     def validate_module(self, pipeline):
-        for group in self.single_measurements:
-            group.validate_group()
+        joint_classifications = self.get_joint_classifications()
+        for index, (group, measurement_name) in enumerate(zip(
+                self.single_measurements, self.get_measurement_names())):
+            group.validate_group(measurement_name, index,
+                                 joint_classifications)
+        self.bin_plans = self.compile_bin_plans()
+
+    def prepare_run(self, workspace):
+        '''Compile the bin plans before the first cycle'''
+        self.bin_plans = self.compile_bin_plans()
+        return True
+
+    def add_experiment_statistics(self, measurements):
+        '''Combine the per-bin image measurements of every image set into
+        experiment measurements
+
+        measurements - measurements holding every image set, such as those
+                       of post_run
+        '''
+        image_numbers = list(measurements.get_image_numbers())
+        for plan in self.get_bin_plans():
+            if not plan.wants_statistics:
+                continue
+            statistics = BinStatistics(plan.bin_count)
+            totals = []
+            for features in (plan.count_features, plan.sum_features,
+                             plan.sum_of_squares_features):
+                #
+                # Image sets that weren't classified have no value
+                #
+                totals.append(np.array([
+                    np.sum([value for value in measurements.get_measurement(
+                        cpmeas.IMAGE, feature, image_numbers)
+                        if value is not None])
+                    for feature in features]))
+            statistics.add(*totals)
+            values = [(F_TOTAL_PER_BIN, statistics.count),
+                      (F_MEAN_PER_BIN, statistics.get_mean()),
+                      (F_STDEV_PER_BIN, statistics.get_std_dev())]
+            for statistic, per_bin in values:
+                for feature, value in zip(
+                        plan.statistics_features[statistic], per_bin):
+                    measurements.add_experiment_measurement(feature, value)
+
+    def reclassify(self, measurements, chunk_size=RECLASSIFY_CHUNK_SIZE):
+        '''Classify the objects of an earlier run again
+
+        measurements - the measurements of the earlier run, for instance
+                       opened from its measurements file. The
+                       classifications are written to them.
+        chunk_size - the number of image sets whose object measurements
+                     are read at a time
+
+        The objects are classified with the module's current settings using
+        the measurements recorded for each image set, so no images are
+        processed or made. All of the image sets are one group for
+        equal-frequency bins.
+        '''
+        self.bin_plans = self.compile_bin_plans()
+        self.quantile_buffers = {}
+        image_numbers = list(measurements.get_image_numbers())
+        for object_name, plans in self.get_object_groups():
+            binned = [(index, plan) for index, plan in plans
+                      if not plan.is_quantile]
+            for start in range(0, len(image_numbers), chunk_size):
+                chunk = image_numbers[start:start + chunk_size]
+                chunk_values = [measurements.get_measurement(
+                    object_name, plan.feature, chunk) for _, plan in plans]
+                for i, image_set_number in enumerate(chunk):
+                    values = dict([
+                        (index, np.zeros(0) if plan_values[i] is None
+                         else np.asarray(plan_values[i], float))
+                        for (index, _), plan_values in zip(
+                            plans, chunk_values)])
+                    for index, plan in plans:
+                        if plan.is_quantile:
+                            self.add_quantile_values(
+                                index, values[index], image_set_number)
+                    if len(binned) == 0:
+                        continue
+                    self.classify_values(
+                        binned, [values[index] for index, _ in binned],
+                        [plan.get_thresholds(measurements, image_set_number)
+                         for _, plan in binned],
+                        measurements, image_set_number=image_set_number)
+        self.classify_quantile_buffers(measurements)
+        self.add_experiment_statistics(measurements)
 
     def upgrade_settings(self, setting_values, variable_revision_number,
                          module_name, from_matlab):
@@ -551,25 +2719,190 @@ class ClassifyObjects(cpm.CPModule):
         they should leave things as-is so that the caller can report
         an error.
         '''
+        if variable_revision_number == 1:
+            # Added the output image precision
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number, [IP_FLOAT64])
+            variable_revision_number = 2
+        if variable_revision_number == 2:
+            # Added the output image type and the pixels to render
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number,
+                [IT_COLOR, RM_ALL])
+            variable_revision_number = 3
+        if variable_revision_number == 3:
+            # Added per-bin statistics across the experiment
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number, [NO])
+            variable_revision_number = 4
+        if variable_revision_number == 4:
+            # Added the per-object classification output
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number, [OO_ONE_HOT])
+            variable_revision_number = 5
+        if variable_revision_number == 5:
+            # Added the timing of each step
+            setting_values = list(setting_values) + [NO]
+            variable_revision_number = 6
+        if variable_revision_number == 6:
+            # Added the choice of data kept for the display window
+            setting_values = list(setting_values) + [DM_FULL]
+            variable_revision_number = 7
+        if variable_revision_number == 7:
+            # Added joint classification
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number, [NO])
+            variable_revision_number = 8
+        if variable_revision_number == 8:
+            # Added thresholds from measurements of parent objects
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number,
+                [NO, cps.NONE, cps.NONE, cps.NONE])
+            variable_revision_number = 9
+        if variable_revision_number == 9:
+            # Added the number of threads for rendering images
+            setting_values = list(setting_values) + ["1"]
+            variable_revision_number = 10
+        if variable_revision_number == 10:
+            # Added tiled rendering and images in temporary files
+            setting_values = list(setting_values) + [NO, "1024", NO]
+            variable_revision_number = 11
+        if variable_revision_number == 11:
+            # Added the result cache
+            setting_values = list(setting_values) + [NO, "", "1024", NO]
+            variable_revision_number = 12
+        if variable_revision_number == 12:
+            # Added the per-object reason for being outside of every bin
+            setting_values = self.append_group_settings(
+                setting_values, variable_revision_number, [NO])
+            variable_revision_number = 13
         return setting_values, variable_revision_number, from_matlab
 
+    @staticmethod
+    def append_group_settings(setting_values, variable_revision_number,
+                              new_values):
+        '''Add settings to the end of every classification
+
+        setting_values - the setting values as saved at
+                         variable_revision_number
+        variable_revision_number - the revision the values were saved at
+        new_values - the values of the new settings, in order
+        '''
+        group_setting_count = GROUP_SETTING_COUNTS[variable_revision_number]
+        single_measurement_count = int(setting_values[0])
+        result = list(setting_values[:1])
+        for i in range(single_measurement_count):
+            start = 1 + i * group_setting_count
+            result += setting_values[start:start + group_setting_count]
+            result += new_values
+        result += setting_values[
+            1 + single_measurement_count * group_setting_count:]
+        return result
+
     def get_measurement_columns(self, pipeline):
         columns = []
-        for group in self.single_measurements:
+        measurement_names = self.get_measurement_names()
+        for group, measurement_name in zip(
+                self.single_measurements, measurement_names):
+            bin_feature_names = group.bin_feature_names(measurement_name)
+            first_column = len(columns)
             columns += [(cpmeas.IMAGE,
                          '_'.join((M_CATEGORY, feature_name, F_NUM_PER_BIN)),
                          cpmeas.COLTYPE_INTEGER)
-                        for feature_name in group.bin_feature_names()]
+                        for feature_name in bin_feature_names]
             columns += [(cpmeas.IMAGE,
                          '_'.join((M_CATEGORY, feature_name, F_PCT_PER_BIN)),
                          cpmeas.COLTYPE_FLOAT)
-                        for feature_name in group.bin_feature_names()]
+                        for feature_name in bin_feature_names]
+            columns += [(cpmeas.IMAGE, '_'.join((M_CATEGORY, feature_name)),
+                         cpmeas.COLTYPE_INTEGER)
+                        for feature_name in get_no_bin_features(
+                            measurement_name)]
+            if group.object_output == OO_BIN_NUMBER:
+                object_coltype = bin_number_coltype(group.number_of_bins())
+            else:
+                object_coltype = COLTYPE_TINYINT
             columns += [(group.object_name.value,
                          '_'.join((M_CATEGORY, feature_name)),
+                         object_coltype)
+                        for feature_name in self.get_object_features(
+                            group, measurement_name)]
+            if group.wants_statistics():
+                columns += [(cpmeas.IMAGE,
+                             '_'.join((M_CATEGORY, feature_name, sum_feature)),
+                             cpmeas.COLTYPE_FLOAT)
+                            for sum_feature in (F_SUM_PER_BIN,
+                                                F_SUM_OF_SQUARES_PER_BIN)
+                            for feature_name in bin_feature_names]
+                columns += [
+                    (cpmeas.EXPERIMENT,
+                     '_'.join((M_CATEGORY, feature_name, statistic)),
+                     cpmeas.COLTYPE_INTEGER if statistic == F_TOTAL_PER_BIN
+                     else cpmeas.COLTYPE_FLOAT)
+                    for statistic in F_STATISTICS_PER_BIN
+                    for feature_name in bin_feature_names]
+            if group.bin_choice == BC_QUANTILE:
+                #
+                # Equal-frequency bins are only classified in post_group
+                #
+                columns[first_column:] = [
+                    column + ({cpmeas.MCA_AVAILABLE_POST_GROUP: True},)
+                    for column in columns[first_column:]]
+        for chain in self.get_joint_classifications():
+            measurement_name, feature_names = self.get_joint_features(
+                chain, measurement_names)
+            columns += [(cpmeas.IMAGE,
+                         '_'.join((M_CATEGORY, feature_name, image_feature)),
+                         coltype)
+                        for image_feature, coltype in (
+                            (F_NUM_PER_BIN, cpmeas.COLTYPE_INTEGER),
+                            (F_PCT_PER_BIN, cpmeas.COLTYPE_FLOAT))
+                        for feature_name in feature_names]
+            columns += [(cpmeas.IMAGE, '_'.join((M_CATEGORY, feature_name)),
                          cpmeas.COLTYPE_INTEGER)
-                        for feature_name in group.bin_feature_names()]
+                        for feature_name in get_no_bin_features(
+                            measurement_name)]
+            columns += [(self.single_measurements[chain[0]].object_name.value,
+                         '_'.join((M_CATEGORY, measurement_name,
+                                   F_JOINT_BIN)),
+                         bin_number_coltype(len(feature_names)))]
+        if self.wants_stage_timing:
+            columns += [(cpmeas.IMAGE,
+                         get_stage_feature(object_name, stage, unit),
+                         cpmeas.COLTYPE_FLOAT if unit == F_STAGE_SECONDS
+                         else cpmeas.COLTYPE_INTEGER)
+                        for object_name in self.get_timed_object_names()
+                        for stage in STAGES
+                        for unit in (F_STAGE_SECONDS, F_STAGE_BYTES)]
         return columns
 
+    def get_timed_object_names(self):
+        '''Return the names of the objects whose steps are timed, in order
+        '''
+        result = []
+        for group in self.single_measurements:
+            if group.object_name.value not in result:
+                result.append(group.object_name.value)
+        return result
+
+    def get_object_features(self, group, measurement_name=None):
+        '''Return the per-object features of a classification, without the
+        category
+
+        group - the classification's settings group
+        measurement_name - the group's measurement_name() if already known
+        '''
+        if measurement_name is None:
+            measurement_name = group.measurement_name()
+        if group.object_output == OO_BIN_NUMBER:
+            result = ['_'.join((measurement_name, F_BIN_NUMBER))]
+        else:
+            result = group.bin_feature_names(measurement_name)
+        if group.wants_no_bin_reasons:
+            result = result + [
+                '_'.join((measurement_name, F_NO_BIN_REASON))]
+        return result
+
     def get_categories(self, pipeline, object_name):
         """Return the categories of measurements that this module
         produces
@@ -581,6 +2914,10 @@ class ClassifyObjects(cpm.CPModule):
             (object_name in [group.object_name.value
                              for group in self.single_measurements])):
             return [M_CATEGORY]
+        if (object_name == cpmeas.EXPERIMENT and
+            any([group.wants_statistics()
+                 for group in self.single_measurements])):
+            return [M_CATEGORY]
 
         return []
 
@@ -594,13 +2931,111 @@ class ClassifyObjects(cpm.CPModule):
         if category != M_CATEGORY:
             return []
         result = []
-        for group in self.single_measurements:
+        measurement_names = self.get_measurement_names()
+        if object_name == cpmeas.EXPERIMENT:
+            for group, measurement_name in zip(
+                    self.single_measurements, measurement_names):
+                if group.wants_statistics():
+                    result += ['_'.join((feature_name, statistic))
+                               for statistic in F_STATISTICS_PER_BIN
+                               for feature_name in group.bin_feature_names(
+                                   measurement_name)]
+            return result
+        for group, measurement_name in zip(
+                self.single_measurements, measurement_names):
             if group.object_name == object_name:
-                return group.bin_feature_names()
+                result += self.get_object_features(group, measurement_name)
             elif object_name == cpmeas.IMAGE:
-                for image_features in (F_NUM_PER_BIN, F_PCT_PER_BIN):
-                    for bin_feature_names in group.bin_feature_names():
-                        result += [
-                            '_'.join((bin_feature_names, image_features))]
-                return result
-        return []
+                bin_feature_names = group.bin_feature_names(measurement_name)
+                image_features = [F_NUM_PER_BIN, F_PCT_PER_BIN]
+                if group.wants_statistics():
+                    image_features += [F_SUM_PER_BIN,
+                                       F_SUM_OF_SQUARES_PER_BIN]
+                for image_feature in image_features:
+                    result += ['_'.join((feature_name, image_feature))
+                               for feature_name in bin_feature_names]
+                result += get_no_bin_features(measurement_name)
+        for chain in self.get_joint_classifications():
+            measurement_name, feature_names = self.get_joint_features(
+                chain, measurement_names)
+            if self.single_measurements[chain[0]].object_name == object_name:
+                result += ['_'.join((measurement_name, F_JOINT_BIN))]
+            elif object_name == cpmeas.IMAGE:
+                result += ['_'.join((feature_name, image_feature))
+                           for image_feature in (F_NUM_PER_BIN, F_PCT_PER_BIN)
+                           for feature_name in feature_names]
+                result += get_no_bin_features(measurement_name)
+        if object_name == cpmeas.IMAGE and self.wants_stage_timing:
+            result += [get_stage_feature(timed_object_name, stage, unit,
+                                         category=None)
+                       for timed_object_name in self.get_timed_object_names()
+                       for stage in STAGES
+                       for unit in (F_STAGE_SECONDS, F_STAGE_BYTES)]
+        return result
+
+
+def main(args=None):
+    '''Classify the objects of a measurements file again
+
+    Run this file with --help to see the options.
+    '''
+    parser = argparse.ArgumentParser(
+        description="Classify the objects in a CellProfiler measurements "
+        "file again, with the settings of the %s modules of a pipeline and "
+        "without processing any images." % ClassifyObjects.module_name,
+        epilog="Measurements that the pipeline does not make, such as those "
+        "of bins or outputs of earlier settings, are left in the file "
+        "unchanged. Remove them before analysis if the bins have changed.")
+    parser.add_argument("measurements",
+                        help="the measurements (.h5) file of an earlier run")
+    parser.add_argument("--pipeline",
+                        help="the pipeline whose classifications are used "
+                        "and which is saved in the measurements in place of "
+                        "the earlier one (default: the pipeline saved in the "
+                        "measurements)")
+    parser.add_argument("--output",
+                        help="write to a copy of the measurements file "
+                        "(default: update the measurements file)")
+    parser.add_argument("--chunk-size", type=int,
+                        default=RECLASSIFY_CHUNK_SIZE,
+                        help="the number of image sets to read at a time")
+    options = parser.parse_args(args)
+
+    cpprefs.set_headless()
+    #
+    # Let the pipeline load this module even if it isn't in the plugins
+    # directory. cellprofiler.modules loads the plugins, so it can only be
+    # imported here.
+    #
+    import cellprofiler.modules as cpmodules
+    cpmodules.add_module_for_tst(ClassifyObjects)
+    path = options.measurements
+    if options.output is not None:
+        shutil.copyfile(path, options.output)
+        path = options.output
+    measurements = cpmeas.Measurements(filename=path, mode="r+")
+    try:
+        pipeline = cpp.Pipeline()
+        if options.pipeline is None:
+            pipeline.load(StringIO(measurements.get_experiment_measurement(
+                cpp.M_PIPELINE)))
+        else:
+            pipeline.load(options.pipeline)
+        modules = [module for module in pipeline.modules()
+                   if module.module_name == ClassifyObjects.module_name]
+        if len(modules) == 0:
+            parser.error("The pipeline has no %s module" %
+                         ClassifyObjects.module_name)
+        for module in modules:
+            module.reclassify(measurements, options.chunk_size)
+        if options.pipeline is not None:
+            #
+            # Record the settings that made the classifications
+            #
+            pipeline.write_pipeline_measurement(measurements)
+    finally:
+        measurements.close()
+
+
+if __name__ == "__main__":
+    main()
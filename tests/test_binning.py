@@ -0,0 +1,293 @@
+'''Tests that DynamicClassifyObjects bins objects exactly as it used to
+
+The reference is the original classification: a cross product of objects
+and bin edges built with np.mgrid, bin_hits[object, bin] being True where
+the object's value is in the bin.
+
+Run from the repository root with CellProfiler importable:
+
+    python -m unittest discover tests
+'''
+
+# This module is distributed under the GNU General Public License.
+# See the accompanying file LICENSE for details.
+#
+# Copyright (c) 2014 Edward J. Stronge
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import cellprofiler.measurements as cpmeas
+import dynamicclassifyobjects as dco
+import benchmark_dynamicclassifyobjects as bench
+
+
+def reference_bin_hits(values, thresholds):
+    '''The original classification of each object into each bin'''
+    values = np.asarray(values, float)
+    thresholds = np.asarray(thresholds, float)
+    ob_idx, th_idx = np.mgrid[0:len(values), 0:len(thresholds)-1]
+    return ((values[ob_idx] > thresholds[th_idx]) &
+            (values[ob_idx] <= thresholds[th_idx+1]))
+
+
+def one_hot(bin_index, bin_count):
+    return bin_index[:, np.newaxis] == np.arange(bin_count)
+
+
+SPECIAL_VALUES = np.array([np.nan, np.inf, -np.inf, 0, 1, -1, .5, 2, -2])
+
+SORTED_EDGES = [
+    [0, 1],
+    [-1, 0, .5, 2],
+    [-np.inf, 0, .25, .5, .75, 1, np.inf],
+    [0, 0, 1],
+    [.5, .5],
+    [-np.inf, np.inf]]
+
+# Edges from an image-based low threshold above the high threshold. No
+# value is in more than one bin.
+UNSORTED_EDGES = [
+    [1, .75, .5, .25, 0],
+    [2, 1],
+    [np.nan, 0, 1],
+    [0, np.nan, 1]]
+
+
+def make_values(seed, count=200):
+    '''Random values, a fifth of them special, ending with each special
+    value'''
+    r = np.random.RandomState(seed)
+    values = r.uniform(-1.5, 2.5, count)
+    special = r.uniform(size=count) < .2
+    values[special] = r.choice(SPECIAL_VALUES, np.sum(special))
+    return np.hstack((values, SPECIAL_VALUES))
+
+
+class TestBinning(unittest.TestCase):
+    def check_same(self, values, thresholds):
+        bin_hits = reference_bin_hits(values, thresholds)
+        bin_count = len(thresholds) - 1
+        bin_index = dco.bin_values(values, thresholds)
+        np.testing.assert_array_equal(one_hot(bin_index, bin_count),
+                                      bin_hits)
+        np.testing.assert_array_equal(dco.count_bins(bin_index, bin_count),
+                                      bin_hits.sum(0))
+
+    def test_01_sorted_edges(self):
+        for seed in range(5):
+            for thresholds in SORTED_EDGES:
+                self.check_same(make_values(seed), thresholds)
+
+    def test_02_values_on_edges(self):
+        for thresholds in SORTED_EDGES + UNSORTED_EDGES:
+            self.check_same(np.array(thresholds, float), thresholds)
+
+    def test_03_unsorted_edges(self):
+        for seed in range(5):
+            for thresholds in UNSORTED_EDGES:
+                self.check_same(make_values(seed), thresholds)
+
+    def test_04_overlapping_bins(self):
+        #
+        # Edges out of order with bins for the values below and above
+        # them overlap. The original put an object in every bin that held
+        # it, the module puts it in the first one.
+        #
+        thresholds = [-np.inf, 1, .5, 0, np.inf]
+        values = make_values(0)
+        bin_hits = reference_bin_hits(values, thresholds)
+        bin_index = dco.bin_values(values, thresholds)
+        hit = bin_hits.any(1)
+        np.testing.assert_array_equal(bin_index >= 0, hit)
+        np.testing.assert_array_equal(bin_index[hit],
+                                      np.argmax(bin_hits[hit], 1))
+
+    def test_05_no_objects(self):
+        for thresholds in SORTED_EDGES + UNSORTED_EDGES:
+            bin_index = dco.bin_values(np.zeros(0), thresholds)
+            self.assertEqual(len(bin_index), 0)
+            np.testing.assert_array_equal(
+                dco.count_bins(bin_index, len(thresholds) - 1),
+                np.zeros(len(thresholds) - 1, int))
+
+    def test_06_count_bins_stack(self):
+        values = make_values(1)
+        thresholds = SORTED_EDGES[:3]
+        bin_indexes = np.vstack([dco.bin_values(values, edges)
+                                 for edges in thresholds])
+        counts = dco.count_bins(bin_indexes,
+                                [len(edges) - 1 for edges in thresholds])
+        for count, edges in zip(counts, thresholds):
+            np.testing.assert_array_equal(
+                count, reference_bin_hits(values, edges).sum(0))
+
+    def test_07_no_bin_reasons(self):
+        values = make_values(2)
+        for thresholds in SORTED_EDGES + UNSORTED_EDGES:
+            bin_index = dco.bin_values(values, thresholds)
+            outside = bin_index < 0
+            #
+            # Objects between the first and last edges are only outside
+            # of every bin if an edge is NaN
+            #
+            np.testing.assert_array_equal(
+                bin_index[outside],
+                np.where(values <= thresholds[0], dco.NB_BELOW,
+                         np.where(values > thresholds[-1], dco.NB_ABOVE,
+                                  dco.NB_NAN))[outside])
+            self.assertTrue(np.all(bin_index[np.isnan(values)] ==
+                                   dco.NB_NAN))
+
+
+class TestQuantile(unittest.TestCase):
+    def check_bins(self, values, bin_count):
+        '''Check that each value is in the bin that encloses it and return
+        the number of values in each bin'''
+        cuts = dco.get_quantile_cuts(values, bin_count)
+        bin_index = dco.bin_quantile_values(values, cuts)
+        np.testing.assert_array_equal(bin_index[np.isnan(values)],
+                                      dco.NB_NAN)
+        #
+        # -inf is in the first bin rather than below it
+        #
+        above = values > -np.inf
+        np.testing.assert_array_equal(bin_index[values == -np.inf], 0)
+        edges = np.hstack(([-np.inf], cuts, [np.inf]))
+        np.testing.assert_array_equal(
+            bin_index[above], dco.bin_values(values[above], edges))
+        return dco.count_bins(bin_index, bin_count)
+
+    def test_01_clustered_values(self):
+        r = np.random.RandomState(0)
+        for values in (r.normal(.5, .005, 100000),
+                       r.normal(1000, 10, 100000)):
+            values = values.astype(np.float32)
+            for bin_count in (1, 2, 4, 7):
+                counts = self.check_bins(values, bin_count)
+                # Only ties between the single-precision values unbalance
+                # the bins
+                self.assertLessEqual(counts.max() - counts.min(), 10)
+
+    def test_02_special_values(self):
+        for seed in range(3):
+            self.check_bins(make_values(seed).astype(np.float32), 3)
+
+    def test_03_no_values(self):
+        for values in (np.zeros(0, np.float32),
+                       np.array([np.nan, np.nan], np.float32)):
+            cuts = dco.get_quantile_cuts(values, 4)
+            np.testing.assert_array_equal(
+                dco.bin_quantile_values(values, cuts), dco.NB_NAN)
+
+    def test_04_run_group(self):
+        #
+        # The bins are chosen from the objects of every image set of the
+        # group
+        #
+        r = np.random.RandomState(1)
+        workspace = bench.make_workspace(1000, 64, 1, .25, 0)
+        measurements = workspace.measurements
+        feature = bench.FEATURE_FORMAT % 0
+        module = bench.make_module(1, 4, False, dco.RM_ALL)
+        group = module.single_measurements[0]
+        group.bin_choice.value = dco.BC_QUANTILE
+        module.prepare_run(workspace)
+        module.prepare_group(workspace, {}, [1, 2, 3])
+        for image_number in (1, 2, 3):
+            measurements.add_measurement(
+                bench.OBJECT_NAME, feature,
+                r.normal(image_number, .001, 1000),
+                image_set_number=image_number)
+            measurements.image_set_number = image_number
+            module.run(workspace)
+        module.post_group(workspace, {})
+        totals = np.zeros(4, int)
+        for image_number in (1, 2, 3):
+            totals += [measurements.get_measurement(
+                cpmeas.IMAGE, '_'.join(
+                    (dco.M_CATEGORY, feature_name, dco.F_NUM_PER_BIN)),
+                image_number)
+                for feature_name in group.bin_feature_names()]
+        np.testing.assert_array_equal(totals, 750)
+
+    def test_05_post_group_columns(self):
+        module = bench.make_module(2, 4, False, dco.RM_ALL)
+        module.single_measurements[0].bin_choice.value = dco.BC_QUANTILE
+        quantile_name, other_name = module.get_measurement_names()
+        for column in module.get_measurement_columns(None):
+            post_group = (len(column) > 3 and column[3].get(
+                cpmeas.MCA_AVAILABLE_POST_GROUP, False))
+            self.assertEqual(post_group, quantile_name in column[1])
+
+
+class TestRun(unittest.TestCase):
+    '''Run the module on the benchmarks' stand-in workspace'''
+
+    def run_module(self, values, **kwargs):
+        workspace = bench.make_workspace(max(len(values), 1), 64, 1, .25, 0)
+        measurements = workspace.measurements
+        measurements.add_measurement(
+            bench.OBJECT_NAME, bench.FEATURE_FORMAT % 0, values)
+        module = bench.make_module(1, 4, True, dco.RM_ALL)
+        group = module.single_measurements[0]
+        for name, value in kwargs.items():
+            getattr(group, name).value = value
+        module.prepare_run(workspace)
+        module.run(workspace)
+        return module, measurements
+
+    def check_run(self, values, thresholds, **kwargs):
+        module, measurements = self.run_module(values, **kwargs)
+        group = module.single_measurements[0]
+        bin_hits = reference_bin_hits(values, thresholds)
+        for bin_idx, feature_name in enumerate(group.bin_feature_names()):
+            np.testing.assert_array_equal(
+                measurements.get_current_measurement(
+                    bench.OBJECT_NAME, '_'.join(
+                        (dco.M_CATEGORY, feature_name))),
+                bin_hits[:, bin_idx].astype(int))
+            num_hits = bin_hits[:, bin_idx].sum()
+            self.assertEqual(
+                measurements.get_current_image_measurement('_'.join(
+                    (dco.M_CATEGORY, feature_name, dco.F_NUM_PER_BIN))),
+                num_hits)
+            self.assertEqual(
+                measurements.get_current_image_measurement('_'.join(
+                    (dco.M_CATEGORY, feature_name, dco.F_PCT_PER_BIN))),
+                100.0*float(num_hits)/len(values) if len(values) > 0 else 0)
+
+    def test_01_even_bins(self):
+        values = make_values(3)
+        # Low threshold measurement is .1 and the high threshold .9
+        thresholds = np.hstack(([-np.inf], np.linspace(.1, .9, 5),
+                                [np.inf]))
+        self.check_run(values, thresholds)
+
+    def test_02_custom_bins(self):
+        values = make_values(4)
+        self.check_run(values, [-1, 0, .5, 2], bin_choice=dco.BC_CUSTOM,
+                       custom_thresholds="-1,0,.5,2", wants_low_bin=False,
+                       wants_high_bin=False)
+
+    def test_03_unsorted_image_thresholds(self):
+        values = make_values(5)
+        # The low threshold measurement, .1, is above the high threshold
+        self.check_run(values, np.linspace(.1, 0, 5), wants_low_bin=False,
+                       wants_high_bin=False, high_threshold=0)
+
+    def test_04_no_objects(self):
+        self.check_run(np.zeros(0), np.linspace(.1, .9, 5),
+                       wants_low_bin=False, wants_high_bin=False,
+                       wants_images=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
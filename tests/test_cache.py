@@ -0,0 +1,153 @@
+'''Tests of the result cache that reuses the classifications of earlier runs
+
+Run from the repository root with CellProfiler importable:
+
+    python -m unittest discover tests
+'''
+
+# This module is distributed under the GNU General Public License.
+# See the accompanying file LICENSE for details.
+#
+# Copyright (c) 2014 Edward J. Stronge
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import cellprofiler.measurements as cpmeas
+import dynamicclassifyobjects as dco
+import benchmark_dynamicclassifyobjects as bench
+
+
+class RecordingCache(dco.ResultCache):
+    '''A ResultCache that records whether each lookup was a hit'''
+
+    def __init__(self, directory, max_bytes):
+        dco.ResultCache.__init__(self, directory, max_bytes)
+        self.hits = []
+
+    def get(self, key):
+        result = dco.ResultCache.get(self, key)
+        self.hits.append(result is not None)
+        return result
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_module(self):
+        module = bench.make_module(2, 4, True, dco.RM_ALL)
+        module.wants_result_cache.value = True
+        module.cache_directory.value = self.directory
+        module.wants_cached_images.value = True
+        module.result_cache = RecordingCache(
+            self.directory, module.cache_size.value * 1024 * 1024)
+        return module
+
+    def run_module(self, module, workspace=None):
+        '''Run the module on a new workspace and return it and the hits'''
+        if workspace is None:
+            workspace = bench.make_workspace(500, 64, 2, .25, 0)
+        module.result_cache.hits = []
+        module.prepare_run(workspace)
+        module.run(workspace)
+        return workspace, module.result_cache.hits
+
+    def test_01_hit(self):
+        module = self.make_module()
+        first, hits = self.run_module(module)
+        # One lookup for the classifications and one for the images
+        self.assertEqual(hits, [False, False])
+        second, hits = self.run_module(module)
+        self.assertEqual(hits, [True, True])
+        expected = first.measurements.measurements
+        actual = second.measurements.measurements
+        self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+        for key, value in expected.items():
+            self.assertEqual(np.asarray(actual[key]).dtype,
+                             np.asarray(value).dtype, key)
+            np.testing.assert_array_equal(actual[key], value)
+        self.assertEqual(sorted(first.image_set.images.keys()),
+                         sorted(second.image_set.images.keys()))
+        for name, image in first.image_set.images.items():
+            np.testing.assert_array_equal(
+                second.image_set.images[name].pixel_data, image.pixel_data)
+
+    def test_02_narrow_bin_indexes(self):
+        module = self.make_module()
+        self.run_module(module)
+        stored = []
+        for filename in os.listdir(self.directory):
+            data = np.load(os.path.join(self.directory, filename))
+            try:
+                if "bin_indexes" in data.files:
+                    stored.append(data["bin_indexes"].dtype)
+            finally:
+                data.close()
+        self.assertEqual(stored, [np.int8])
+
+    def test_03_setting_changed(self):
+        module = self.make_module()
+        self.run_module(module)
+        module.single_measurements[1].bin_count.value = 5
+        _, hits = self.run_module(module)
+        self.assertEqual(hits, [False, False])
+
+    def test_04_threshold_changed(self):
+        module = self.make_module()
+        self.run_module(module)
+        workspace = bench.make_workspace(500, 64, 2, .25, 0)
+        workspace.measurements.add_measurement(
+            cpmeas.IMAGE, bench.LOW_THRESHOLD_FEATURE, .2)
+        _, hits = self.run_module(module, workspace)
+        self.assertEqual(hits, [False, False])
+
+    def test_05_labels_changed(self):
+        module = self.make_module()
+        self.run_module(module)
+        workspace = bench.make_workspace(500, 64, 2, .25, 0)
+        objects = workspace.object_set.get_objects(bench.OBJECT_NAME)
+        objects.segmented[:8] = 0
+        _, hits = self.run_module(module, workspace)
+        # The classifications are reused but the images are drawn again
+        self.assertEqual(hits, [True, False])
+
+    def test_06_evict_least_recently_used(self):
+        arrays = dict(values=np.arange(1000))
+        cache = dco.ResultCache(self.directory, 1 << 30)
+        cache.put("probe", arrays)
+        entry_size = os.path.getsize(cache.get_path("probe"))
+        os.remove(cache.get_path("probe"))
+        cache = dco.ResultCache(self.directory, entry_size * 5 // 2)
+        now = time.time()
+        for age, key in ((100, "a"), (50, "b")):
+            cache.put(key, arrays)
+            os.utime(cache.get_path(key), (now - age, now - age))
+        # Using "a" makes "b" the least recently used
+        self.assertIsNotNone(cache.get("a"))
+        cache.put("c", arrays)
+        self.assertTrue(os.path.exists(cache.get_path("a")))
+        self.assertFalse(os.path.exists(cache.get_path("b")))
+        self.assertTrue(os.path.exists(cache.get_path("c")))
+        cache.put("d", arrays)
+        self.assertFalse(os.path.exists(cache.get_path("a")))
+        self.assertEqual(cache.get("b"), None)
+        self.assertIsNotNone(cache.get("c"))
+        self.assertIsNotNone(cache.get("d"))
+
+
+if __name__ == "__main__":
+    unittest.main()
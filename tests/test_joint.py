@@ -0,0 +1,80 @@
+'''Tests of joint classifications
+
+Run from the repository root with CellProfiler importable:
+
+    python -m unittest discover tests
+'''
+
+# This module is distributed under the GNU General Public License.
+# See the accompanying file LICENSE for details.
+#
+# Copyright (c) 2014 Edward J. Stronge
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import cellprofiler.settings as cps
+import dynamicclassifyobjects as dco
+import benchmark_dynamicclassifyobjects as bench
+
+
+class TestJoint(unittest.TestCase):
+    def make_module(self):
+        module = bench.make_module(3, 2, False, dco.RM_ALL)
+        for group in module.single_measurements[1:]:
+            group.wants_joint_classification.value = True
+        return module
+
+    def get_joint_features(self, module):
+        return [column[1] for column in module.get_measurement_columns(None)
+                if column[1].endswith(dco.F_JOINT_BIN)]
+
+    def test_01_joint(self):
+        module = self.make_module()
+        self.assertEqual(module.get_joint_classifications(), [[0, 1, 2]])
+        module.validate_module(None)
+        self.assertEqual(len(self.get_joint_features(module)), 1)
+
+    def test_02_hidden_joint_setting(self):
+        #
+        # A "Yes" left over from before the group was switched to
+        # equal-frequency bins, where the setting is hidden, is ignored
+        #
+        module = self.make_module()
+        group = module.single_measurements[2]
+        group.bin_choice.value = dco.BC_QUANTILE
+        self.assertNotIn(group.wants_joint_classification,
+                         module.visible_settings())
+        self.assertEqual(module.get_joint_classifications(), [[0, 1]])
+        module.validate_module(None)
+        joint_features = self.get_joint_features(module)
+        self.assertEqual(len(joint_features), 1)
+        plans = module.compile_bin_plans()
+        self.assertEqual(plans[1].joint_plan.bin_number_feature,
+                         joint_features[0])
+        self.assertIsNone(plans[2].joint_plan)
+
+    def test_03_joint_with_equal_frequency(self):
+        #
+        # Joining a group to an equal-frequency one above it is an error on
+        # the visible setting
+        #
+        module = self.make_module()
+        module.single_measurements[1].bin_choice.value = dco.BC_QUANTILE
+        try:
+            module.validate_module(None)
+        except cps.ValidationError as e:
+            self.assertIs(e.get_setting(),
+                          module.single_measurements[2]
+                          .wants_joint_classification)
+        else:
+            self.fail("Expected a validation error")
+
+
+if __name__ == "__main__":
+    unittest.main()
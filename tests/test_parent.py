@@ -0,0 +1,181 @@
+'''Tests of bin edges taken from measurements of each object's parent
+
+Run from the repository root with CellProfiler importable:
+
+    python -m unittest discover tests
+'''
+
+# This module is distributed under the GNU General Public License.
+# See the accompanying file LICENSE for details.
+#
+# Copyright (c) 2014 Edward J. Stronge
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import cellprofiler.measurements as cpmeas
+import dynamicclassifyobjects as dco
+import benchmark_dynamicclassifyobjects as bench
+from test_binning import reference_bin_hits, make_values, SPECIAL_VALUES
+
+PARENT_NAME = "Cells"
+LOW_FEATURE = "Parent_Low"
+HIGH_FEATURE = "Parent_High"
+
+# The low and high thresholds of each parent: sorted, equal, low above
+# high, and NaN in either or both
+PARENT_LOW = np.array([0, .5, 1, np.nan, 0, np.nan, -np.inf])
+PARENT_HIGH = np.array([1, .5, 0, 1, np.nan, np.nan, np.inf])
+
+# Each object's parent: none, every parent, and numbers out of range
+PARENTS = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, -1, 100])
+
+
+def reference_bin_index(values, thresholds):
+    '''Bin each object with the original classification and its own edges
+
+    An object in more than one bin of out-of-order edges is in the first.
+    Objects in none get their no-bin reason.
+    '''
+    bin_index = np.zeros(len(values), int)
+    for i, (value, edges) in enumerate(zip(values, thresholds)):
+        hits = reference_bin_hits([value], edges)[0]
+        if np.any(hits):
+            bin_index[i] = np.argmax(hits)
+        else:
+            bin_index[i] = dco.get_no_bin_reasons(
+                np.array([value]), edges[0], edges[-1])[0]
+    return bin_index
+
+
+def make_thresholds(low, high, bin_count, wants_low_bin, wants_high_bin):
+    '''Evenly spaced edges between each low and high threshold'''
+    thresholds = low[:, np.newaxis] + np.arange(bin_count + 1) * (
+        high - low)[:, np.newaxis] / float(bin_count)
+    columns = [thresholds]
+    if wants_low_bin:
+        columns.insert(0, np.zeros((len(low), 1)) - np.inf)
+    if wants_high_bin:
+        columns.append(np.zeros((len(low), 1)) + np.inf)
+    return np.hstack(columns)
+
+
+class TestBinValuesPerObject(unittest.TestCase):
+    def test_01_rows_per_object(self):
+        for seed in range(3):
+            values = make_values(seed, 50)
+            r = np.random.RandomState(seed)
+            rows = r.randint(0, len(PARENT_LOW), len(values))
+            for wants_low_bin in (False, True):
+                for wants_high_bin in (False, True):
+                    thresholds = make_thresholds(
+                        PARENT_LOW, PARENT_HIGH, 3, wants_low_bin,
+                        wants_high_bin)
+                    expected = reference_bin_index(values, thresholds[rows])
+                    np.testing.assert_array_equal(
+                        dco.bin_values_per_object(values, thresholds[rows]),
+                        expected)
+                    np.testing.assert_array_equal(
+                        dco.bin_values_per_object(values, thresholds, rows),
+                        expected)
+
+    def test_02_nan_edges(self):
+        values = SPECIAL_VALUES
+        thresholds = np.zeros((len(values), 4)) + np.nan
+        np.testing.assert_array_equal(
+            dco.bin_values_per_object(values, thresholds), dco.NB_NAN)
+
+    def test_03_no_objects(self):
+        thresholds = make_thresholds(PARENT_LOW, PARENT_HIGH, 3, True, True)
+        self.assertEqual(len(dco.bin_values_per_object(
+            np.zeros(0), thresholds, np.zeros(0, int))), 0)
+        self.assertEqual(len(dco.bin_values_per_object(
+            np.zeros(0), thresholds[:0])), 0)
+
+
+class TestParentThresholds(unittest.TestCase):
+    def make_workspace(self, values):
+        workspace = bench.make_workspace(len(values), 64, 1, .25, 0)
+        measurements = workspace.measurements
+        measurements.add_measurement(
+            bench.OBJECT_NAME, bench.FEATURE_FORMAT % 0, values)
+        measurements.add_measurement(
+            bench.OBJECT_NAME, cpmeas.FF_PARENT % PARENT_NAME, PARENTS)
+        measurements.add_measurement(PARENT_NAME, LOW_FEATURE, PARENT_LOW)
+        measurements.add_measurement(PARENT_NAME, HIGH_FEATURE, PARENT_HIGH)
+        return workspace
+
+    def make_module(self, wants_low_bin, wants_high_bin):
+        module = bench.make_module(1, 3, False, dco.RM_ALL)
+        group = module.single_measurements[0]
+        group.wants_parent_thresholds.value = True
+        group.parent_name.value = PARENT_NAME
+        group.low_parent_measurement.value = LOW_FEATURE
+        group.high_parent_measurement.value = HIGH_FEATURE
+        group.wants_low_bin.value = wants_low_bin
+        group.wants_high_bin.value = wants_high_bin
+        group.object_output.value = dco.OO_BIN_NUMBER
+        group.wants_no_bin_reasons.value = True
+        return module
+
+    def test_01_parent_values(self):
+        module = self.make_module(True, True)
+        workspace = self.make_workspace(np.zeros(len(PARENTS)))
+        plan = module.get_bin_plans()[0]
+        np.testing.assert_array_equal(
+            plan.get_parent_values(workspace.measurements, LOW_FEATURE,
+                                   PARENTS),
+            np.hstack(([np.nan], PARENT_LOW, [np.nan] * 3)))
+
+    def test_02_missing_parent_measurement(self):
+        module = self.make_module(True, True)
+        workspace = self.make_workspace(np.zeros(len(PARENTS)))
+        workspace.measurements.add_measurement(
+            PARENT_NAME, LOW_FEATURE, None)
+        plan = module.get_bin_plans()[0]
+        self.assertTrue(np.all(np.isnan(plan.get_parent_values(
+            workspace.measurements, LOW_FEATURE, PARENTS))))
+
+    def test_03_run(self):
+        #
+        # Classify each object by each value in turn
+        #
+        parent_low = np.hstack(([np.nan], PARENT_LOW))
+        parent_high = np.hstack(([np.nan], PARENT_HIGH))
+        has_parent = (PARENTS > 0) & (PARENTS <= len(PARENT_LOW))
+        parents = np.where(has_parent, PARENTS, 0)
+        for wants_low_bin in (False, True):
+            for wants_high_bin in (False, True):
+                thresholds = make_thresholds(
+                    parent_low[parents], parent_high[parents], 3,
+                    wants_low_bin, wants_high_bin)
+                for value in SPECIAL_VALUES:
+                    values = np.zeros(len(PARENTS)) + value
+                    module = self.make_module(wants_low_bin, wants_high_bin)
+                    workspace = self.make_workspace(values)
+                    module.prepare_run(workspace)
+                    module.run(workspace)
+                    plan = module.get_bin_plans()[0]
+                    expected = reference_bin_index(values, thresholds)
+                    measurements = workspace.measurements
+                    np.testing.assert_array_equal(
+                        measurements.get_current_measurement(
+                            bench.OBJECT_NAME, plan.bin_number_feature),
+                        np.maximum(expected + 1, 0))
+                    np.testing.assert_array_equal(
+                        measurements.get_current_measurement(
+                            bench.OBJECT_NAME, plan.no_bin_reason_feature),
+                        np.minimum(expected, 0))
+                    # Objects without a parent are in no bin
+                    self.assertTrue(np.all(expected[~has_parent] < 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
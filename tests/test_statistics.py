@@ -0,0 +1,138 @@
+'''Tests of the per-bin statistics combined across image sets
+
+Run from the repository root with CellProfiler importable:
+
+    python -m unittest discover tests
+'''
+
+# This module is distributed under the GNU General Public License.
+# See the accompanying file LICENSE for details.
+#
+# Copyright (c) 2014 Edward J. Stronge
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import cellprofiler.measurements as cpmeas
+import dynamicclassifyobjects as dco
+import benchmark_dynamicclassifyobjects as bench
+
+
+class TestStatistics(unittest.TestCase):
+    def make_module(self):
+        module = bench.make_module(1, 4, False, dco.RM_ALL)
+        module.single_measurements[0].wants_bin_statistics.value = True
+        return module
+
+    def make_workspace(self):
+        '''A workspace with the objects of three image sets'''
+        workspace = bench.make_workspace(100, 64, 1, .25, 0)
+        measurements = workspace.measurements
+        feature = bench.FEATURE_FORMAT % 0
+        values = measurements.get_current_measurement(
+            bench.OBJECT_NAME, feature)
+        for image_number in (2, 3):
+            measurements.add_measurement(
+                bench.OBJECT_NAME, feature, values * image_number / 4.0,
+                image_set_number=image_number)
+            measurements.add_measurement(
+                cpmeas.IMAGE, bench.LOW_THRESHOLD_FEATURE, .1,
+                image_set_number=image_number)
+        all_values = np.hstack([values * n / 4.0 if n > 1 else values
+                                for n in (1, 2, 3)])
+        return workspace, all_values
+
+    def run_image_set(self, module, workspace, image_number):
+        workspace.measurements.image_set_number = image_number
+        module.run(workspace)
+
+    def check_statistics(self, module, measurements, all_values):
+        thresholds = np.hstack(([-np.inf], np.linspace(.1, .9, 5),
+                                [np.inf]))
+        bin_index = dco.bin_values(all_values, thresholds)
+        group = module.single_measurements[0]
+
+        def get_statistic(feature_name, statistic):
+            return measurements.get_measurement(
+                cpmeas.EXPERIMENT, '_'.join(
+                    (dco.M_CATEGORY, feature_name, statistic)))
+
+        for k, feature_name in enumerate(group.bin_feature_names()):
+            in_bin = all_values[bin_index == k]
+            self.assertEqual(
+                get_statistic(feature_name, dco.F_TOTAL_PER_BIN),
+                len(in_bin))
+            if len(in_bin) > 0:
+                self.assertAlmostEqual(
+                    get_statistic(feature_name, dco.F_MEAN_PER_BIN),
+                    np.mean(in_bin))
+                self.assertAlmostEqual(
+                    get_statistic(feature_name, dco.F_STDEV_PER_BIN),
+                    np.std(in_bin))
+            else:
+                self.assertTrue(np.isnan(
+                    get_statistic(feature_name, dco.F_MEAN_PER_BIN)))
+
+    def test_01_aggregation_module(self):
+        module = self.make_module()
+        self.assertFalse(module.is_aggregation_module())
+        module.single_measurements[0].bin_choice.value = dco.BC_QUANTILE
+        self.assertTrue(module.is_aggregation_module())
+
+    def test_02_run_statistics(self):
+        module = self.make_module()
+        workspace, all_values = self.make_workspace()
+        module.prepare_run(workspace)
+        for image_number in (1, 2, 3):
+            self.run_image_set(module, workspace, image_number)
+        module.post_run(workspace)
+        self.check_statistics(module, workspace.measurements, all_values)
+
+    def test_03_statistics_of_workers(self):
+        #
+        # Image sets classified by different copies of the module, as in
+        # separate worker processes, are combined in post_run from the
+        # image measurements alone.
+        #
+        workspace, all_values = self.make_workspace()
+        for image_number in (3, 1, 2):
+            module = self.make_module()
+            module.prepare_run(workspace)
+            self.run_image_set(module, workspace, image_number)
+        module = self.make_module()
+        module.post_run(workspace)
+        self.check_statistics(module, workspace.measurements, all_values)
+
+    def test_04_image_columns(self):
+        module = self.make_module()
+        image_features = [
+            column[1] for column in module.get_measurement_columns(None)
+            if column[0] == cpmeas.IMAGE]
+        for feature_name in module.single_measurements[0].bin_feature_names():
+            for statistic in (dco.F_SUM_PER_BIN,
+                              dco.F_SUM_OF_SQUARES_PER_BIN):
+                self.assertIn(
+                    '_'.join((dco.M_CATEGORY, feature_name, statistic)),
+                    image_features)
+
+    def test_05_no_quantile_statistics(self):
+        module = self.make_module()
+        module.single_measurements[0].bin_choice.value = dco.BC_QUANTILE
+        self.assertFalse(any([
+            column[0] == cpmeas.EXPERIMENT
+            for column in module.get_measurement_columns(None)]))
+        self.assertEqual(
+            module.get_categories(None, cpmeas.EXPERIMENT), [])
+        self.assertEqual(module.get_measurements(
+            None, cpmeas.EXPERIMENT, dco.M_CATEGORY), [])
+
+
+if __name__ == "__main__":
+    unittest.main()